@@ -36,6 +36,5 @@ else
     build_breakpad
     build_stackwalk
     cp $DIR/breakpad/src/tools/linux/dump_syms/dump_syms $DIR/../oopsypad/bin/
-    cp $DIR/breakpad/src/processor/minidump_stackwalk $DIR/../oopsypad/bin/
     cp $DIR/minidump-stackwalk/stackwalker $DIR/../oopsypad/bin/
 fi
@@ -100,6 +100,10 @@ class HTTPSymbolSupplier : public SimpleSymbolSupplier {
   // Returns true if stats were found, false if not.
   bool GetStats(const CodeModule* module, SymbolStats* stats) const;
 
+  // Forget symbol files that failed to download, so that they are
+  // requested again (e.g. for the next minidump in --server mode).
+  void ClearErrors() { error_symbols_.clear(); }
+
  private:
   bool FetchSymbolFile(const CodeModule* module, const SystemInfo* system_info);
 
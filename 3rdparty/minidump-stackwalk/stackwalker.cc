@@ -33,7 +33,9 @@
 #include <algorithm>
 #include <fstream>
 #include <iostream>
+#include <list>
 #include <map>
+#include <memory>
 #include <ostream>
 #include <vector>
 #include <set>
@@ -46,6 +48,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/stat.h>
 #include <unistd.h>
 
 #include "common/scoped_ptr.h"
@@ -60,6 +63,7 @@
 #include "google_breakpad/processor/stackwalker.h"
 #include "google_breakpad/processor/stack_frame_cpu.h"
 #include "google_breakpad/processor/stack_frame_symbolizer.h"
+#include "processor/basic_code_module.h"
 #include "processor/pathname_stripper.h"
 #include "processor/simple_symbol_supplier.h"
 
@@ -67,6 +71,7 @@
 #include "http_symbol_supplier.h"
 #include "json/json.h"
 
+using google_breakpad::BasicCodeModule;
 using google_breakpad::BasicSourceLineResolver;
 using google_breakpad::CallStack;
 using google_breakpad::CodeModule;
@@ -98,6 +103,7 @@ using google_breakpad::SymbolSupplier;
 using google_breakpad::SystemInfo;
 using breakpad_extra::HTTPSymbolSupplier;
 
+using std::list;
 using std::map;
 using std::string;
 using std::vector;
@@ -117,6 +123,13 @@ const unsigned kMaxThreadFrames = 100;
 // should be preserved at the end of the frame list.
 const unsigned kTailFramesWhenTruncating = 10;
 
+// Number of modules the --server mode keeps symbols loaded for.
+const int kDefaultCacheModules = 64;
+
+// Total size in bytes of the symbol files the --server mode keeps loaded
+// (0 means no limit).  Parsed symbols take a few times more memory.
+const uint64_t kDefaultCacheSize = 256 * 1024 * 1024;
+
 static string ToHex(uint64_t value) {
   char buffer[32];
   sprintf(buffer, "0x%lx", value);
@@ -129,21 +142,119 @@ static string ToInt(uint64_t value) {
   return buffer;
 }
 
+// ModuleCache tracks the modules whose symbols are loaded into a resolver
+// shared between minidumps (see --server).  Once more than |max_modules|
+// modules or symbol files of more than |max_size| bytes in total are
+// loaded the least recently used ones are unloaded.  The resolver
+// identifies modules by code file only, so a module is also unloaded when
+// a minidump refers to another build of the same code file.
+class ModuleCache {
+public:
+  ModuleCache(SourceLineResolverInterface* resolver,
+              SymbolSupplier* supplier,
+              size_t max_modules,
+              uint64_t max_size)
+    : resolver_(resolver), supplier_(supplier), max_modules_(max_modules),
+      max_size_(max_size), size_(0) {}
+
+  // Called before symbolizing a frame that belongs to |module|.
+  void Prepare(const CodeModule* module) {
+    EntryMap::iterator entry = entries_.find(module->code_file());
+    if (entry != entries_.end() &&
+        entry->second.module->debug_identifier() !=
+          module->debug_identifier()) {
+      Unload(entry);
+    }
+  }
+
+  // Called after symbols of |module| were used by the resolver.
+  void Touch(const CodeModule* module, const SystemInfo* system_info) {
+    const string& key = module->code_file();
+    EntryMap::iterator entry = entries_.find(key);
+    if (entry != entries_.end()) {
+      lru_.erase(entry->second.position);
+    } else {
+      entry = entries_.insert(std::make_pair(key, Entry())).first;
+      entry->second.module.reset(new BasicCodeModule(module));
+      entry->second.size = GetSymbolFileSize(module, system_info);
+      size_ += entry->second.size;
+    }
+    lru_.push_front(key);
+    entry->second.position = lru_.begin();
+  }
+
+  // Unload least recently used modules above the limits.
+  void Trim() {
+    while (entries_.size() > max_modules_ ||
+           (max_size_ && size_ > max_size_)) {
+      Unload(entries_.find(lru_.back()));
+    }
+  }
+
+private:
+  struct Entry {
+    std::shared_ptr<BasicCodeModule> module;
+    list<string>::iterator position;
+    uint64_t size;
+  };
+  typedef map<string, Entry> EntryMap;
+
+  uint64_t GetSymbolFileSize(const CodeModule* module,
+                             const SystemInfo* system_info) {
+    string symbol_file;
+    struct stat st;
+    if (supplier_ &&
+        supplier_->GetSymbolFile(module, system_info, &symbol_file) ==
+          SymbolSupplier::FOUND &&
+        stat(symbol_file.c_str(), &st) == 0) {
+      return st.st_size;
+    }
+    return 0;
+  }
+
+  void Unload(EntryMap::iterator entry) {
+    resolver_->UnloadModule(entry->second.module.get());
+    size_ -= entry->second.size;
+    lru_.erase(entry->second.position);
+    entries_.erase(entry);
+  }
+
+  SourceLineResolverInterface* resolver_;
+  SymbolSupplier* supplier_;
+  size_t max_modules_;
+  uint64_t max_size_;
+  uint64_t size_;  // Of the loaded symbol files
+  EntryMap entries_;
+  list<string> lru_;  // Code files, most recently used first.
+};
+
 class StackFrameSymbolizerForward : public StackFrameSymbolizer {
 public:
   StackFrameSymbolizerForward(SymbolSupplier* supplier,
-                              SourceLineResolverInterface* resolver)
-    : StackFrameSymbolizer(supplier, resolver) {}
+                              SourceLineResolverInterface* resolver,
+                              ModuleCache* cache = nullptr)
+    : StackFrameSymbolizer(supplier, resolver), cache_(cache) {}
 
   virtual SymbolizerResult FillSourceLineInfo(const CodeModules* modules,
                                               const SystemInfo* system_info,
                                               StackFrame* stack_frame) {
+    if (cache_ && modules) {
+      const CodeModule* module =
+        modules->GetModuleForAddress(stack_frame->instruction);
+      if (module)
+        cache_->Prepare(module);
+    }
     SymbolizerResult res =
       StackFrameSymbolizer::FillSourceLineInfo(modules,
                                                NULL, // unloaded_modules
                                                system_info,
                                                stack_frame);
     RecordResult(stack_frame->module, res);
+    if (cache_ && stack_frame->module &&
+        (res == SymbolizerResult::kNoError ||
+         res == SymbolizerResult::kWarningCorruptSymbols)) {
+      cache_->Touch(stack_frame->module, system_info);
+    }
     return res;
   }
 
@@ -158,6 +269,7 @@ private:
     }
   }
   std::set<const CodeModule*> loaded_modules_;
+  ModuleCache* cache_;
 };
 
 string FrameTrust(StackFrame::FrameTrust trust) {
@@ -672,6 +784,13 @@ static void ConvertProcessStateToJSON(const ProcessState& process_state,
   }
   root["crash_info"] = crash_info;
 
+  // Process uptime in seconds, if the dump recorded the process start time.
+  if (process_state.process_create_time() > 0 &&
+      process_state.time_date_stamp() >= process_state.process_create_time()) {
+    root["process_uptime"] = static_cast<Json::UInt>(
+      process_state.time_date_stamp() - process_state.process_create_time());
+  }
+
   Json::Value modules(Json::arrayValue);
   int main_module = ConvertModulesToJSON(process_state, symbolizer,
                                          supplier, modules);
@@ -728,7 +847,7 @@ static void ConvertProcessStateToJSON(const ProcessState& process_state,
 }
 
 static void ConvertMemoryInfoToJSON(Minidump& dump,
-                                    Json::Value& raw_root,
+                                    const Json::Value& raw_root,
                                     Json::Value& root)
 {
   MinidumpMemoryInfoList* memory_info_list = dump.GetMemoryInfoList();
@@ -1111,12 +1230,117 @@ static void PrintProcessStateMachineReadable(const ProcessState& process_state)
 
 //*** End of copy-paste from minidump_stackwalk.cc ***
 
+// ProcessMinidump walks the minidump at |minidump_path| and returns its
+// JSON representation.  |resolver| (and |cache|, if any) may be shared
+// between calls so symbols are loaded only once.
+static Json::Value ProcessMinidump(const string& minidump_path,
+                                   SymbolSupplier* symbol_supplier,
+                                   HTTPSymbolSupplier* http_symbol_supplier,
+                                   SourceLineResolverInterface* resolver,
+                                   ModuleCache* cache,
+                                   const Json::Value& raw_root,
+                                   bool pipe) {
+  Minidump minidump(minidump_path);
+  minidump.Read();
+  // process minidump
+  // bug 950710 - Bad symbol files are causing the stackwalker to
+  // run amok. Disabling this until we get an upstream fix.
+  //Stackwalker::set_max_frames(UINT32_MAX);
+  Json::Value root;
+  // The symbolizer remembers modules without symbols, so it is created per
+  // minidump: symbols uploaded in the meantime are picked up by --server.
+  StackFrameSymbolizerForward symbolizer(symbol_supplier, resolver, cache);
+  MinidumpProcessor minidump_processor(&symbolizer, true);
+  ProcessState process_state;
+  ProcessResult result =
+    minidump_processor.Process(&minidump, &process_state);
+
+  if (pipe) {
+    if (result == google_breakpad::PROCESS_OK) {
+      PrintProcessStateMachineReadable(process_state);
+    }
+    printf("====PIPE DUMP ENDS===\n");
+  }
+
+  root["status"] = ResultString(result);
+  root["sensitive"] = Json::Value(Json::objectValue);
+  if (result == google_breakpad::PROCESS_OK) {
+    ConvertProcessStateToJSON(process_state, symbolizer,
+                              http_symbol_supplier, root, raw_root);
+  }
+  ConvertMemoryInfoToJSON(minidump, raw_root, root);
+
+  // Get the PID.
+  MinidumpMiscInfo* misc_info = minidump.GetMiscInfo();
+  if (misc_info && misc_info->misc_info() &&
+      (misc_info->misc_info()->flags1 & MD_MISCINFO_FLAGS1_PROCESS_ID)) {
+    root["pid"] = misc_info->misc_info()->process_id;
+  }
+
+  // See if this is a Linux dump with /proc/cpuinfo in it
+  uint32_t cpuinfo_length = 0;
+  if (process_state.system_info()->os == "Linux" &&
+      minidump.SeekToStreamType(MD_LINUX_CPU_INFO, &cpuinfo_length)) {
+    string contents;
+    contents.resize(cpuinfo_length);
+    if (minidump.ReadBytes(const_cast<char*>(contents.data()), cpuinfo_length)) {
+      ConvertCPUInfoToJSON(contents, root);
+    }
+  }
+
+  // See if this is a Linux dump with /etc/lsb-release in it
+  uint32_t length = 0;
+  if (process_state.system_info()->os == "Linux" &&
+      minidump.SeekToStreamType(MD_LINUX_LSB_RELEASE, &length)) {
+    string contents;
+    contents.resize(length);
+    if (minidump.ReadBytes(const_cast<char*>(contents.data()), length)) {
+      ConvertLSBReleaseToJSON(contents, root);
+    }
+  }
+
+  return root;
+}
+
+// ServeMinidumps reads minidump paths from stdin, one per line, and writes
+// the JSON of every minidump to stdout as a single line.  Parsed symbols
+// are kept in memory between minidumps, up to |max_modules| modules and
+// symbol files of |max_size| bytes in total.
+static void ServeMinidumps(SymbolSupplier* symbol_supplier,
+                           HTTPSymbolSupplier* http_symbol_supplier,
+                           size_t max_modules,
+                           uint64_t max_size) {
+  BasicSourceLineResolver resolver;
+  ModuleCache cache(&resolver, symbol_supplier, max_modules, max_size);
+  Json::Value raw_root(Json::objectValue);
+  Json::FastWriter writer;
+  string minidump_path;
+  while (std::getline(std::cin, minidump_path)) {
+    if (minidump_path.empty())
+      continue;
+    // Symbol files may have been uploaded since the previous minidump.
+    if (http_symbol_supplier)
+      http_symbol_supplier->ClearErrors();
+    Json::Value root = ProcessMinidump(minidump_path, symbol_supplier,
+                                       http_symbol_supplier, &resolver,
+                                       &cache, raw_root, false);
+    cache.Trim();
+    // FastWriter terminates the document with a newline.
+    fputs(writer.write(root).c_str(), stdout);
+    fflush(stdout);
+  }
+}
+
 void usage() {
   fprintf(stderr, "Usage: stackwalker [options] <minidump> [<symbol paths]\n");
+  fprintf(stderr, "       stackwalker --server [options] [<symbol paths]\n");
   fprintf(stderr, "Options:\n");
   fprintf(stderr, "\t--pretty\tPretty-print JSON output.\n");
   fprintf(stderr, "\t--pipe-dump\tProduce pipe-delimited output in addition to JSON output\n");
   fprintf(stderr, "\t--raw-json\tAn input file with the raw annotations as JSON\n");
+  fprintf(stderr, "\t--server\tRead minidump paths from stdin and write one JSON line per minidump, keeping symbols loaded\n");
+  fprintf(stderr, "\t--cache-modules\tMaximum number of modules to keep symbols loaded for in --server mode (default %d)\n", kDefaultCacheModules);
+  fprintf(stderr, "\t--cache-size\tMaximum total size in bytes of the symbol files to keep loaded in --server mode, 0 for no limit (default %" PRIu64 ")\n", kDefaultCacheSize);
   http_commandline_usage();
   fprintf(stderr, "\t--help\tDisplay this help text.\n");
 }
@@ -1126,6 +1350,9 @@ int main(int argc, char** argv)
 {
   bool pretty = false;
   bool pipe = false;
+  bool server = false;
+  size_t cache_modules = kDefaultCacheModules;
+  uint64_t cache_size = kDefaultCacheSize;
   char* json_path = nullptr;
   // Yeah, this is ugly.
   vector<char*> symbols_urls;
@@ -1135,6 +1362,9 @@ int main(int argc, char** argv)
     {"pretty", no_argument, nullptr, 'p'},
     {"pipe-dump", no_argument, nullptr, 'i'},
     {"raw-json", required_argument, nullptr, 'r'},
+    {"server", no_argument, nullptr, 'S'},
+    {"cache-modules", required_argument, nullptr, 'm'},
+    {"cache-size", required_argument, nullptr, 'M'},
     HTTP_COMMANDLINE_OPTIONS
     {"help", no_argument, nullptr, 'h'},
     {nullptr, 0, nullptr, 0}
@@ -1157,6 +1387,15 @@ int main(int argc, char** argv)
     case 'r':
       json_path = optarg;
       break;
+    case 'S':
+      server = true;
+      break;
+    case 'm':
+      cache_modules = strtoul(optarg, nullptr, 10);
+      break;
+    case 'M':
+      cache_size = strtoull(optarg, nullptr, 10);
+      break;
     HANDLE_HTTP_COMMANDLINE_OPTIONS
     case 'h':
       usage();
@@ -1170,7 +1409,7 @@ int main(int argc, char** argv)
     }
   }
 
-  if (optind >= argc) {
+  if (!server && optind >= argc) {
     usage();
     return 1;
   }
@@ -1182,19 +1421,12 @@ int main(int argc, char** argv)
     return 1;
   }
 
-  Minidump minidump(argv[optind]);
   vector<string> symbol_paths;
   // allow symbol paths to be passed on the commandline.
-  for (int i = optind + 1; i < argc; i++) {
+  for (int i = server ? optind : optind + 1; i < argc; i++) {
     symbol_paths.push_back(argv[i]);
   }
 
-  minidump.Read();
-  // process minidump
-  // bug 950710 - Bad symbol files are causing the stackwalker to
-  // run amok. Disabling this until we get an upstream fix.
-  //Stackwalker::set_max_frames(UINT32_MAX);
-  Json::Value root;
   scoped_ptr<SymbolSupplier> symbol_supplier;
   HTTPSymbolSupplier* http_symbol_supplier = nullptr;
   if (!symbols_urls.empty()) {
@@ -1208,18 +1440,10 @@ int main(int argc, char** argv)
     symbol_supplier.reset(new SimpleSymbolSupplier(symbol_paths));
   }
 
-  BasicSourceLineResolver resolver;
-  StackFrameSymbolizerForward symbolizer(symbol_supplier.get(), &resolver);
-  MinidumpProcessor minidump_processor(&symbolizer, true);
-  ProcessState process_state;
-  ProcessResult result =
-    minidump_processor.Process(&minidump, &process_state);
-
-  if (pipe) {
-    if (result == google_breakpad::PROCESS_OK) {
-      PrintProcessStateMachineReadable(process_state);
-    }
-    printf("====PIPE DUMP ENDS===\n");
+  if (server) {
+    ServeMinidumps(symbol_supplier.get(), http_symbol_supplier,
+                   cache_modules, cache_size);
+    exit(0);
   }
 
   Json::Value raw_root(Json::objectValue);
@@ -1229,42 +1453,10 @@ int main(int argc, char** argv)
     reader.parse(raw_stream, raw_root);
   }
 
-  root["status"] = ResultString(result);
-  root["sensitive"] = Json::Value(Json::objectValue);
-  if (result == google_breakpad::PROCESS_OK) {
-    ConvertProcessStateToJSON(process_state, symbolizer,
-                              http_symbol_supplier, root, raw_root);
-  }
-  ConvertMemoryInfoToJSON(minidump, raw_root, root);
-
-  // Get the PID.
-  MinidumpMiscInfo* misc_info = minidump.GetMiscInfo();
-  if (misc_info && misc_info->misc_info() &&
-      (misc_info->misc_info()->flags1 & MD_MISCINFO_FLAGS1_PROCESS_ID)) {
-    root["pid"] = misc_info->misc_info()->process_id;
-  }
-
-  // See if this is a Linux dump with /proc/cpuinfo in it
-  uint32_t cpuinfo_length = 0;
-  if (process_state.system_info()->os == "Linux" &&
-      minidump.SeekToStreamType(MD_LINUX_CPU_INFO, &cpuinfo_length)) {
-    string contents;
-    contents.resize(cpuinfo_length);
-    if (minidump.ReadBytes(const_cast<char*>(contents.data()), cpuinfo_length)) {
-      ConvertCPUInfoToJSON(contents, root);
-    }
-  }
-
-  // See if this is a Linux dump with /etc/lsb-release in it
-  uint32_t length = 0;
-  if (process_state.system_info()->os == "Linux" &&
-      minidump.SeekToStreamType(MD_LINUX_LSB_RELEASE, &length)) {
-    string contents;
-    contents.resize(length);
-    if (minidump.ReadBytes(const_cast<char*>(contents.data()), length)) {
-      ConvertLSBReleaseToJSON(contents, root);
-    }
-  }
+  BasicSourceLineResolver resolver;
+  Json::Value root = ProcessMinidump(argv[optind], symbol_supplier.get(),
+                                     http_symbol_supplier, &resolver,
+                                     nullptr, raw_root, pipe);
 
   scoped_ptr<Json::Writer> writer;
   if (pretty)
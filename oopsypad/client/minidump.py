@@ -1,3 +1,7 @@
+from contextlib import ExitStack
+import json
+import os
+
 import click
 import requests
 
@@ -36,3 +40,21 @@ def send_crash_report(address, dump_path, product, version, platform):
         response = requests.post(
             '{}/crash-report'.format(address), data=data, files=files)
     return response
+
+
+def send_crash_reports(address, dump_paths, product, version, platform,
+                       metadata=None):
+    """
+    Send several minidumps in one request. `metadata`, if given, is a list
+    of dicts overriding product, version or platform for each minidump.
+    """
+    with ExitStack() as stack:
+        data = {'product': product, 'version': version, 'platform': platform,
+                'metadata': json.dumps(metadata or [])}
+        files = [('upload_file_minidump',
+                  (os.path.basename(path), stack.enter_context(
+                      open(path, 'rb'))))
+                 for path in dump_paths]
+        response = requests.post(
+            '{}/crash-report/batch'.format(address), data=data, files=files)
+    return response
@@ -1,5 +1,7 @@
-from flask import (after_this_request, Blueprint, current_app, jsonify, request,
-                   flash, redirect)
+import json
+
+from flask import (abort, after_this_request, Blueprint, current_app, jsonify,
+                   request, flash, redirect)
 from flask_security import current_user, http_auth_required
 from flask_security.utils import (get_post_register_redirect, hash_password,
                                   login_user, url_for_security)
@@ -8,6 +10,9 @@ from werkzeug.local import LocalProxy
 
 from oopsypad.server import models
 from oopsypad.server.forms import AdminRegisterForm
+from oopsypad.server.minidump import MinidumpError, read_minidump_info
+from oopsypad.server.streaming import (stream_gridfs_file,
+                                       stream_gzipped_gridfs_file)
 
 bp = Blueprint('public', __name__)
 
@@ -22,44 +27,57 @@ def get_auth_token():
     return jsonify(token=current_user.auth_token)
 
 
+def validate_crash_report(product, version, platform):
+    """
+    Return the error message if a crash report can't be accepted.
+    """
+    if not product:
+        return 'Product name is required.'
+
+    if not version:
+        return 'Product version is required.'
+
+    if not platform:
+        return 'Product platform is required.'
+
+    project = models.Project.get_cached_policy(product)
+    if not project:
+        return '{} project not found.'.format(product)
+
+    if project.min_version and version < project.min_version:
+        return ('You use an old version. Please download at least {} '
+                'release.'.format(project.min_version))
+
+    if platform not in project.allowed_platforms:
+        return '{} platform is not allowed for {}.'.format(platform, product)
+
+
 @bp.route('/crash-report', methods=['POST'])
 def crash_report():
     data = request.form
 
     product = data.get('product')
-    if not product:
-        return client_error('Product name is required.')
-
     version = data.get('version')
-    if not version:
-        return client_error('Product version is required.')
-
     platform = data.get('platform')
-    if not platform:
-        return client_error('Product platform is required.')
+    error = validate_crash_report(product, version, platform)
+    if error:
+        return client_error(error)
 
     minidump = request.files.get('upload_file_minidump')
     if not minidump:
         return client_error('Minidump file is required.')
 
-    project = models.Project.objects(name=product).first()
-    if not project:
-        return client_error('{} project not found.'.format(product))
-
-    if project.min_version and version < project.min_version:
-        return client_error(
-            'You use an old version. Please download at least {} '
-            'release.'.format(project.min_version))
-
-    if platform not in project.get_allowed_platforms():
-        return client_error('{} platform is not allowed for {}.'.format(
-            platform, product))
+    try:
+        minidump_info = read_minidump_info(minidump.stream)
+    except MinidumpError as e:
+        return client_error('Invalid minidump file: {}'.format(e))
 
     try:
         models.Minidump.create_minidump(product=product,
                                         version=version,
                                         platform=platform,
-                                        minidump_file=minidump)
+                                        minidump_file=minidump,
+                                        minidump_info=minidump_info)
     except Exception as e:
         error = 'Cannot save crash report: {}'.format(e)
         current_app.logger.exception(error)
@@ -68,6 +86,102 @@ def crash_report():
     return jsonify(ok='Thank you!'), 201
 
 
+@bp.route('/crash-report/batch', methods=['POST'])
+def crash_report_batch():
+    """
+    Accept several minidumps sent as `upload_file_minidump` files.
+
+    `product`, `version` and `platform` form fields apply to all of them
+    unless overridden in `metadata`, a JSON list with an object per file.
+    The status of each minidump is returned in the same order.
+    """
+    minidumps = request.files.getlist('upload_file_minidump')
+    if not minidumps:
+        return client_error('Minidump files are required.')
+
+    try:
+        metadata = json.loads(request.form.get('metadata') or '[]')
+    except ValueError:
+        metadata = None
+    if not isinstance(metadata, list) or \
+            not all(isinstance(item, dict) for item in metadata):
+        return client_error('Metadata must be a JSON list of objects.')
+
+    defaults = {key: request.form.get(key)
+                for key in ('product', 'version', 'platform')}
+    # Projects are validated once per product, version and platform.
+    errors = {}
+    results = []
+    created = []
+    for i, minidump in enumerate(minidumps):
+        item = dict(defaults, **(metadata[i] if i < len(metadata) else {}))
+        key = (item['product'], item['version'], item['platform'])
+        if not all(value is None or isinstance(value, str) for value in key):
+            results.append({'file': minidump.filename, 'status': 400,
+                            'error': 'Product, version and platform must be '
+                                     'strings.'})
+            continue
+        if key not in errors:
+            errors[key] = validate_crash_report(*key)
+        if errors[key]:
+            results.append({'file': minidump.filename, 'status': 400,
+                            'error': errors[key]})
+            continue
+
+        try:
+            minidump_info = read_minidump_info(minidump.stream)
+        except MinidumpError as e:
+            results.append({'file': minidump.filename, 'status': 400,
+                            'error': 'Invalid minidump file: {}'.format(e)})
+            continue
+
+        try:
+            stored, is_new = models.Minidump.store_minidump(
+                product=key[0],
+                version=key[1],
+                platform=key[2],
+                minidump_file=minidump,
+                minidump_info=minidump_info)
+        except Exception as e:
+            error = 'Cannot save crash report: {}'.format(e)
+            current_app.logger.exception(error)
+            results.append({'file': minidump.filename, 'status': 500,
+                            'error': error})
+            continue
+        if is_new:
+            created.append(stored)
+        results.append({'file': minidump.filename, 'status': 201,
+                        'ok': 'Thank you!'})
+
+    if created:
+        models.Minidump.create_stacktraces(created)
+    return jsonify(results=results), 200
+
+
+@bp.route('/symbols/<debug_file>/<debug_id>/<sym_file>')
+def get_symfile(debug_file, debug_id, sym_file):
+    """
+    Serve symfiles in the layout expected by the stackwalker
+    `--symbols-url` option, if SYMBOL_SERVER is enabled.
+    """
+    if not current_app.config['SYMBOL_SERVER']:
+        abort(404)
+    symfile = models.Symfile.objects(symfile_id=debug_id).first()
+    if not symfile or symfile.get_debug_file() != debug_file or \
+            symfile.get_sym_file_name() != sym_file:
+        abort(404)
+    content = symfile.symfile.get()
+    if not content:
+        abort(404)
+
+    etag = str(symfile.symfile.grid_id)
+    if 'gzip' in request.accept_encodings:
+        return stream_gzipped_gridfs_file(content, etag, 'text/plain')
+    response = stream_gridfs_file(content, etag, 'text/plain')
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 _security = LocalProxy(lambda: current_app.extensions['security'])
 _datastore = LocalProxy(lambda: _security.datastore)
 
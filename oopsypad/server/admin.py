@@ -6,8 +6,8 @@ import warnings
 
 from bson import ObjectId
 from dateutil.relativedelta import relativedelta
-from flask import (current_app, escape, flash, jsonify, Markup, redirect,
-                   request, make_response)
+from flask import (abort, current_app, escape, flash, jsonify, Markup,
+                   redirect, request)
 from flask_admin import Admin, AdminIndexView, BaseView, expose
 from flask_admin.actions import action
 from flask_admin.base import MenuLink
@@ -20,6 +20,7 @@ from wtforms import StringField, validators
 
 from oopsypad.server import models
 from oopsypad.server.helpers import last_12_months
+from oopsypad.server.streaming import stream_gridfs_file
 
 
 def date_format(view, value):
@@ -133,9 +134,20 @@ class ProjectView(AdminModelView):
     edit_template = 'admin/edit_project.html'
     form_args = dict(
         min_version={'label': 'Minimum required version of crashed app'},
-        allowed_platforms={'label': 'Allowed platforms'})
+        allowed_platforms={'label': 'Allowed platforms'},
+        retention_days={'label': 'Remove crash reports older than '
+                                 '(days)'},
+        retention_max_per_issue={'label': 'Maximum crash reports kept per '
+                                          'issue'},
+        retention_keep_samples={'label': 'Crash reports always kept per '
+                                         'issue'},
+        queue={'label': 'Processing queue (default if empty)'},
+        priority={'label': 'Processing priority (0 is the highest, 9 is '
+                           'the lowest)'})
     form_create_rules = ('name',)
-    form_edit_rules = ('min_version', 'allowed_platforms')
+    form_edit_rules = ('min_version', 'allowed_platforms', 'retention_days',
+                       'retention_max_per_issue', 'retention_keep_samples',
+                       'queue', 'priority')
     form_overrides = dict(min_version=StringField)
     list_template = 'admin/project_list.html'
 
@@ -177,18 +189,12 @@ class ProjectView(AdminModelView):
         if not project:
             return jsonify({})
 
-        platforms = project.get_allowed_platforms()
-        if version and 'All' not in version:
-            project_minidumps = models.Minidump.objects(product=project.name,
-                                                        version=version)
-        else:
-            project_minidumps = models.Minidump.objects(product=project.name)
-        data = {}
-        for platform in platforms:
-            platform_minidumps = project_minidumps.filter(platform=platform)
-            data[platform] = \
-                models.Minidump.get_last_12_months_minidumps_counts(
-                    platform_minidumps)
+        if version and 'All' in version:
+            version = None
+        data = models.CrashCounter.get_last_12_months_counts(
+            product=project.name,
+            platforms=project.get_allowed_platforms(),
+            version=version)
 
         labels = get_last_12_months_labels()
         return jsonify(
@@ -221,18 +227,23 @@ class CrashReportView(DeveloperModelView):
         'crash_reason',
         'crash_location',
         'process_uptime',
+        'duplicates',
         'date_created'
     ]
     list_template = 'admin/crash_report_list.html'
     named_filter_urls = True
 
+    def get_query(self):
+        return super().get_query().exclude(*models.LARGE_MINIDUMP_FIELDS)
+
     @expose('/download/<minidump_id>')
     def download_minidump(self, minidump_id):
-        minidump = GridFSProxy(ObjectId(minidump_id))
-        file = minidump.read()
-        response = make_response(file)
-        response.mimetype = 'application/octet-stream'
-        return response
+        if not ObjectId.is_valid(minidump_id):
+            abort(404)
+        minidump = GridFSProxy(ObjectId(minidump_id)).get()
+        if not minidump:
+            abort(404)
+        return stream_gridfs_file(minidump, etag=minidump_id)
 
 
 class IssueView(DeveloperModelView):
@@ -245,10 +256,12 @@ class IssueView(DeveloperModelView):
     column_filters = (
         'product',
         'platform',
-        'reason'
+        'reason',
+        'signature'
     )
     column_formatters = dict(
         avg_uptime=lambda v, c, m, n: '{} s'.format(m.avg_uptime),
+        last_seen=lambda v, c, m, n: m.get_last_seen_time(),
         actions=macro('render_actions'),
     )
     column_list = [
@@ -256,6 +269,7 @@ class IssueView(DeveloperModelView):
         'version',
         'reason',
         'location',
+        'signature',
         'avg_uptime',
         'last_seen',
         'total',
@@ -278,18 +292,15 @@ class IssueView(DeveloperModelView):
             flash('Issue not found.')
             return redirect(self.get_url('.index_view'))
 
-        minidumps = models.Minidump.objects(product=issue.product,
-                                            version=issue.version,
-                                            platform=issue.platform,
-                                            crash_reason=issue.reason,
-                                            crash_location=issue.location)
         page_num = int(request.args.get('page') or 1)
         per_page = 10
+        minidumps = issue.get_minidumps().paginate(page=page_num,
+                                                   per_page=per_page)
+        models.Minidump.prefetch_stacktraces(minidumps.items)
         return self.render('admin/issue_details.html',
                            issue=issue,
                            column_details_list=self.column_details_list,
-                           minidumps=minidumps.paginate(page=page_num,
-                                                        per_page=per_page),
+                           minidumps=minidumps,
                            per_page=per_page)
 
     @expose('/resolve', methods=['POST'])
@@ -304,17 +315,32 @@ class IssueView(DeveloperModelView):
             flash('Issue not found.')
             return redirect(self.get_url('.index_view'))
 
-        issue.resolve_issue()
-        flash('Issue has been resolved.')
+        task = self.start_resolving([issue_id])
+        self.flash_task('Issue is being resolved', task)
         return redirect(self.get_url('.index_view'))
 
+    @expose('/resolve/<task_id>')
+    def resolve_status(self, task_id):
+        from oopsypad.server.worker import resolve_issues
+        result = resolve_issues.AsyncResult(task_id)
+        info = result.info if isinstance(result.info, dict) else {}
+        return jsonify(state=result.state, **info)
+
     @action('resolve_issues', 'Resolve selected issues',
             'Are you sure you want to resolve selected issues?')
     def action_resolve_issues(self, ids):
-        issues = models.Issue.objects(id__in=ids)
-        for issue in issues:
-            issue.resolve_issue()
-        flash('Selected issues have been resolved.')
+        task = self.start_resolving(ids)
+        self.flash_task('Selected issues are being resolved', task)
+
+    def flash_task(self, message, task):
+        url = self.get_url('.resolve_status', task_id=task.id)
+        flash(Markup('{} (<a href="{}" target="_blank">task {}</a>).'.format(
+            escape(message), escape(url), escape(task.id))))
+
+    @staticmethod
+    def start_resolving(issue_ids):
+        from oopsypad.server.worker import resolve_issues
+        return resolve_issues.delay([str(i) for i in issue_ids])
 
 
 class UserView(AdminModelView):
@@ -9,7 +9,7 @@ from raven.contrib.flask import Sentry
 from oopsypad.server import api, bp, config
 from oopsypad.server.admin import admin
 from oopsypad.server.demo import create_test_users
-from oopsypad.server.models import db
+from oopsypad.server.models import db, Issue
 from oopsypad.server.security import user_datastore, load_security_extensions
 
 
@@ -62,6 +62,10 @@ def create_app(config_name=None):
         Sentry(app, dsn=app.config['SENTRY_DSN'],
                logging=True, level=logging.ERROR)
 
+    # Drop indexes of older versions which conflict with the current ones
+    with app.app_context():
+        Issue.drop_legacy_indexes()
+
     # Create user roles
     with app.app_context():
         user_datastore.find_or_create_role(name='admin')
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """
+    A thread-safe per-process cache with expiring entries.
+
+    When the cache is full the least recently used entries are evicted.
+    Values (including None) are cached as returned by the loader.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        value = loader()
+        if ttl > 0:
+            with self._lock:
+                self._entries[key] = (value, now + ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
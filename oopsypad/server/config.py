@@ -1,3 +1,4 @@
+from datetime import timedelta
 import os
 
 DEV, TEST, PROD = 'dev', 'test', 'prod'
@@ -16,19 +17,103 @@ class Config:
 
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
 
+    UPLOAD_CHUNK_SIZE = 255 * 1024  # GridFS default chunk size
+
+    # Seconds a worker process keeps project settings used by /crash-report
+    PROJECT_CACHE_TTL = 60
+    # Seconds a worker process keeps users resolved from API tokens and
+    # sessions
+    USER_CACHE_TTL = 60
+
     ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
 
     BIN_DIR = os.path.join(ROOT_DIR, 'bin')
     # 3rd party binaries
     DUMP_SYMS = os.path.join(BIN_DIR, 'dump_syms')
-    MINIDUMP_STACKWALK = os.path.join(BIN_DIR, 'minidump_stackwalk')
     STACKWALKER = os.path.join(BIN_DIR, 'stackwalker')
+    # Keep one stackwalker process per worker with symbols loaded in memory
+    STACKWALKER_SERVER = True
+    STACKWALKER_CACHE_MODULES = 64
+    # Total size in bytes of the symfiles each of these processes keeps
+    # loaded, parsed symbols take a few times more memory (0 means no limit)
+    STACKWALKER_CACHE_SIZE = 256 * 1024 * 1024  # 256 MB
+    # Base URL the stackwalker downloads missing symfiles from, e.g.
+    # 'https://oopsypad.example.com/symbols' (None to use only local ones)
+    STACKWALKER_SYMBOLS_URL = None
+    # Serve uploaded symfiles at /symbols without authentication. Symfiles
+    # reveal function names and source paths, so enable it only where the
+    # endpoint is reachable by the stackwalkers alone.
+    SYMBOL_SERVER = False
+
+    # Crashes are grouped into issues by a signature of the top frames of
+    # the crashing thread. Frames matching SIGNATURE_IRRELEVANT_FRAMES are
+    # skipped, frames matching SIGNATURE_PREFIX_FRAMES don't count towards
+    # SIGNATURE_FRAMES.
+    SIGNATURE_FRAMES = 5
+    SIGNATURE_IRRELEVANT_FRAMES = [
+        r'^(__GI_)?raise$',
+        r'^(__GI_)?abort$',
+        r'^_?assert',
+        r'^__assert_fail',
+        r'^KiFastSystemCallRet$',
+        r'^NtWaitForMultipleObjects',
+        r'^RaiseException$',
+        r'^std::terminate',
+        r'^__cxa_',
+        r'^_CxxThrowException$'
+    ]
+    SIGNATURE_PREFIX_FRAMES = [
+        r'^(__GI_|__libc_)?(malloc|calloc|realloc|free)$',
+        r'^operator new',
+        r'^operator delete',
+        r'^(__)?mem(cpy|move|set|cmp)',
+        r'^str(len|cpy|cmp|ncpy|ncmp)$'
+    ]
+
+    # Minidumps walked before their symfiles were uploaded are reprocessed
+    # in tasks of this many minidumps
+    REPROCESS_BATCH_SIZE = 100
+    # Celery queue for reprocessing, kept apart from new crash reports
+    REPROCESS_QUEUE = 'reprocess'
 
     DUMPS_DIR = os.path.join(ROOT_DIR, 'dumps')
     SYMFILES_DIR = os.path.join(ROOT_DIR, 'symbols')
+    # Symfiles are fetched from the database to SYMFILES_DIR when needed,
+    # the least recently used ones are removed above this size in bytes
+    # (0 means no limit). Symfiles which aren't in the database are kept.
+    SYMBOLS_CACHE_SIZE = 10 * 1024 * 1024 * 1024  # 10 GB
+    # Fetch missing symfiles and walk minidumps again. Without it frames of
+    # modules missing symbols only get function names from symfile
+    # indexes, as these have no stack unwinding information.
+    FETCH_SYMFILES = True
+    # Look up frames left without symbols in symfile indexes
+    SYMINDEX_LOOKUP = True
+    # Fetch symfiles of the modules listed in a minidump before walking it
+    PREFETCH_SYMBOLS = True
+    # Walk minidumps crashed in modules without symfiles only when these
+    # are uploaded
+    DEFER_WITHOUT_SYMBOLS = False
+    # Don't walk minidumps crashed at the same module offset as an already
+    # processed one, take its issue instead (no stacktrace is stored). Only
+    # the crashing frame is compared, so crashes at the same offset reached
+    # from other callers are merged, except in irrelevant and prefix frames
+    # which are always walked.
+    SKIP_KNOWN_CRASHES = False
 
     CELERY_BROKER_URL = 'redis://localhost:6379/1'
     CELERY_RESULT_BACKEND = 'redis://localhost:6379/1'
+    # Queue of new crash reports of projects without their own queue
+    CRASH_REPORT_QUEUE = 'celery'
+    # One prefetched task per pool process and emulated priorities (0 is
+    # the highest) with the Redis broker
+    CELERYD_PREFETCH_MULTIPLIER = 1
+    BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(10))}
+    CELERYBEAT_SCHEDULE = {
+        'apply-retention-policies': {
+            'task': 'oopsypad.server.worker.apply_retention_policies',
+            'schedule': timedelta(hours=1)
+        }
+    }
 
     SECURITY_PASSWORD_HASH = 'sha512_crypt'
     SECURITY_PASSWORD_SALT = SECRET_KEY
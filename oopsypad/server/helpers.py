@@ -1,2 +1,105 @@
+import re
+
+
 def last_12_months():
     return range(11, -1, -1)
+
+
+def format_frame(frame):
+    module = frame.get('module')
+    function = frame.get('function')
+    if module and function:
+        if frame.get('file'):
+            return '{}!{} [{} : {} + {}]'.format(
+                module, function, frame['file'], frame.get('line'),
+                frame.get('function_offset'))
+        return '{}!{} + {}'.format(module, function,
+                                   frame.get('function_offset'))
+    if module:
+        return '{} + {}'.format(module, frame.get('module_offset'))
+    return frame.get('offset')
+
+
+def format_stacktrace(stacktrace_json):
+    """
+    Render stackwalker JSON output as a minidump_stackwalk-like text.
+    """
+    lines = []
+
+    system_info = stacktrace_json.get('system_info', {})
+    lines.append('Operating system: {}'.format(system_info.get('os')))
+    lines.append('                  {}'.format(system_info.get('os_ver')))
+    lines.append('CPU: {}'.format(system_info.get('cpu_arch')))
+    if system_info.get('cpu_info'):
+        lines.append('     {}'.format(system_info['cpu_info']))
+    lines.append('     {} CPU{}'.format(
+        system_info.get('cpu_count'),
+        's' if system_info.get('cpu_count', 1) != 1 else ''))
+    lines.append('')
+
+    crash_info = stacktrace_json.get('crash_info', {})
+    crashing_thread = crash_info.get('crashing_thread')
+    if crash_info.get('type'):
+        lines.append('Crash reason:  {}'.format(crash_info['type']))
+        lines.append('Crash address: {}'.format(crash_info.get('address')))
+    else:
+        lines.append('No crash')
+    if 'process_uptime' in stacktrace_json:
+        lines.append('Process uptime: {} seconds'.format(
+            stacktrace_json['process_uptime']))
+    else:
+        lines.append('Process uptime: not available')
+    lines.append('')
+
+    for thread_index, thread in enumerate(stacktrace_json.get('threads', [])):
+        lines.append('Thread {}{}'.format(
+            thread_index,
+            ' (crashed)' if thread_index == crashing_thread else ''))
+        for frame in thread.get('frames', []):
+            lines.append('{:2}  {}'.format(frame.get('frame'),
+                                           format_frame(frame)))
+            lines.append('    Found by: {}'.format(frame.get('trust')))
+        lines.append('')
+
+    lines.append('Loaded modules:')
+    main_module = stacktrace_json.get('main_module')
+    for i, module in enumerate(stacktrace_json.get('modules', [])):
+        lines.append('{} - {}  {}  {}{}'.format(
+            module.get('base_addr'), module.get('end_addr'),
+            module.get('filename'), module.get('version') or '???',
+            '  (main)' if i == main_module else ''))
+
+    return '\n'.join(lines)
+
+
+def get_frame_signature(frame):
+    function = frame.get('function')
+    if function:
+        return ' '.join(function.split())
+    if frame.get('module'):
+        return '{}@{}'.format(frame['module'], frame.get('module_offset'))
+    return '@{}'.format(frame.get('offset'))
+
+
+def get_signature(frames, max_frames, irrelevant_frames=(),
+                  prefix_frames=()):
+    """
+    Build a crash signature from the top stack frames.
+
+    Frames matching `irrelevant_frames` regexps are skipped; frames
+    matching `prefix_frames` (e.g. allocators) are included but don't
+    count towards `max_frames`, so the signature reaches their caller.
+    """
+    parts = []
+    counted = 0
+    for frame in frames:
+        name = get_frame_signature(frame)
+        if any(re.search(pattern, name) for pattern in irrelevant_frames):
+            continue
+        parts.append(name)
+        if any(re.search(pattern, name) for pattern in prefix_frames):
+            continue
+        counted += 1
+        if counted >= max_frames:
+            break
+    return ' | '.join(parts)
@@ -0,0 +1,265 @@
+"""
+Reader of the minidump parts needed before stackwalking: header, stream
+directory, system info, exception and module list streams.
+
+Structures are unpacked in place from a memory map of the file (or the
+buffer of an in-memory upload), so reading a minidump doesn't copy it.
+"""
+from collections import namedtuple
+import mmap
+import struct
+
+SIGNATURE = b'MDMP'
+VERSION = 0xa793
+
+HEADER = struct.Struct('<4sIIIIIQ')
+DIRECTORY_ENTRY = struct.Struct('<III')
+SYSTEM_INFO = struct.Struct('<HHHBBIIIIIHH')
+# Thread ID, exception record (code, flags, record, address, parameters)
+# and thread context location
+EXCEPTION_STREAM = struct.Struct('<IIIIQQII15QII')
+MODULE = struct.Struct('<QIIII52sIIIIQQ')
+GUID = struct.Struct('<IHH8s')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
+MODULE_LIST_STREAM = 4
+EXCEPTION = 6
+SYSTEM_INFO_STREAM = 7
+# Streams read here, the others are left to the stackwalker
+READ_STREAMS = (MODULE_LIST_STREAM, EXCEPTION, SYSTEM_INFO_STREAM)
+
+CV_PDB70 = 0x53445352  # 'RSDS'
+CV_PDB20 = 0x3031424e  # 'NB10'
+CV_ELF = 0x4270454c  # 'BpEL'
+
+CPU_ARCHITECTURES = {
+    0: 'x86',
+    2: 'mips',
+    3: 'alpha',
+    4: 'ppc',
+    5: 'arm',
+    6: 'ia64',
+    9: 'amd64',
+    12: 'arm64',
+    0x8001: 'sparc',
+    0x8002: 'ppc64',
+    0x8003: 'arm64',
+    0x8004: 'mips64'
+}
+
+# Offset of the instruction pointer in thread contexts, by CPU
+INSTRUCTION_POINTERS = {
+    'x86': (0xb8, UINT32),  # eip
+    'amd64': (0xf8, UINT64),  # rip
+    'arm': (0x40, UINT32),  # pc
+    'arm64': (0x108, UINT64)  # pc
+}
+
+PLATFORMS = {
+    0: 'Windows',
+    1: 'Windows',
+    2: 'Windows NT',
+    3: 'Windows CE',
+    0x8000: 'Unix',
+    0x8101: 'Mac OS X',
+    0x8102: 'iOS',
+    0x8201: 'Linux',
+    0x8202: 'Solaris',
+    0x8203: 'Android',
+    0x8204: 'PS3',
+    0x8205: 'NaCl',
+    0x8206: 'Fuchsia'
+}
+
+MinidumpInfo = namedtuple('MinidumpInfo', ['os', 'cpu_arch', 'cpu_count',
+                                           'crash_address',
+                                           'instruction_pointer',
+                                           'crash_module', 'modules'])
+
+Module = namedtuple('Module', ['filename', 'base_addr', 'size',
+                               'debug_file', 'debug_id'])
+
+
+class MinidumpError(Exception):
+    pass
+
+
+def basename(path):
+    return path.replace('\\', '/').rsplit('/', 1)[-1]
+
+
+def format_guid(data):
+    data1, data2, data3, data4 = GUID.unpack_from(data)
+    return '{:08X}{:04X}{:04X}{}'.format(data1, data2, data3,
+                                         data4.hex().upper())
+
+
+class MinidumpReader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.size = len(buffer)
+        signature, version, streams, directory_rva, _, _, _ = \
+            self.unpack(HEADER, 0)
+        if signature != SIGNATURE:
+            raise MinidumpError('Not a minidump.')
+        if version & 0xffff != VERSION:
+            raise MinidumpError('Unsupported minidump version.')
+
+        self.streams = {}
+        for i in range(streams):
+            stream_type, size, rva = self.unpack(
+                DIRECTORY_ENTRY, directory_rva + i * DIRECTORY_ENTRY.size)
+            # The first stream of a type wins, as in Breakpad.
+            if stream_type not in READ_STREAMS or \
+                    stream_type in self.streams:
+                continue
+            self.check_range(rva, size)
+            self.streams[stream_type] = (rva, size)
+
+    def check_range(self, offset, size):
+        if offset < 0 or offset + size > self.size:
+            raise MinidumpError('Minidump is truncated.')
+
+    def unpack(self, structure, offset):
+        self.check_range(offset, structure.size)
+        return structure.unpack_from(self.buffer, offset)
+
+    def read_bytes(self, offset, size):
+        self.check_range(offset, size)
+        return bytes(self.buffer[offset:offset + size])
+
+    def read_string(self, rva):
+        length, = self.unpack(UINT32, rva)
+        return self.read_bytes(rva + 4, length).decode('utf-16-le',
+                                                       'replace')
+
+    def get_stream(self, stream_type):
+        return self.streams.get(stream_type)
+
+    def get_system_info(self):
+        stream = self.get_stream(SYSTEM_INFO_STREAM)
+        if not stream:
+            return None, None, None
+        (arch, _, _, cpu_count, _, major, minor, build, platform,
+         _, _, _) = self.unpack(SYSTEM_INFO, stream[0])
+        os_name = PLATFORMS.get(platform, hex(platform))
+        cpu_arch = CPU_ARCHITECTURES.get(arch, hex(arch))
+        return ('{} {}.{}.{}'.format(os_name, major, minor, build), cpu_arch,
+                cpu_count)
+
+    def get_instruction_pointer(self, context_size, context_rva, cpu_arch):
+        if cpu_arch not in INSTRUCTION_POINTERS:
+            return None
+        offset, register = INSTRUCTION_POINTERS[cpu_arch]
+        if context_size < offset + register.size:
+            return None
+        return self.unpack(register, context_rva + offset)[0]
+
+    def get_exception(self, cpu_arch):
+        """
+        Return the exception address and the instruction pointer of the
+        crashed thread.  On Linux and macOS the exception address is the
+        faulting data address (si_addr), not where the crash happened.
+        """
+        stream = self.get_stream(EXCEPTION)
+        if not stream:
+            return None, None
+        fields = self.unpack(EXCEPTION_STREAM, stream[0])
+        address, (context_size, context_rva) = fields[5], fields[-2:]
+        return address, self.get_instruction_pointer(context_size,
+                                                     context_rva, cpu_arch)
+
+    def get_debug_info(self, cv_size, cv_rva, filename):
+        if cv_size < 4:
+            return filename, None
+        signature, = self.unpack(UINT32, cv_rva)
+        if signature == CV_PDB70 and cv_size >= 24:
+            # PDB 7.0: GUID, age and PDB file name
+            data = self.read_bytes(cv_rva + 4, cv_size - 4)
+            age, = struct.unpack_from('<I', data, 16)
+            debug_file = data[20:].split(b'\0', 1)[0].decode('utf8',
+                                                             'replace')
+            return (basename(debug_file),
+                    '{}{:X}'.format(format_guid(data), age))
+        if signature == CV_PDB20 and cv_size >= 16:
+            # PDB 2.0: timestamp, age and PDB file name
+            data = self.read_bytes(cv_rva + 8, cv_size - 8)
+            timestamp, age = struct.unpack_from('<II', data)
+            debug_file = data[8:].split(b'\0', 1)[0].decode('utf8',
+                                                            'replace')
+            return basename(debug_file), '{:08X}{:x}'.format(timestamp, age)
+        if signature == CV_ELF:
+            # ELF build ID, truncated or padded to a GUID, with age 0
+            build_id = self.read_bytes(cv_rva + 4, cv_size - 4)
+            return filename, format_guid(build_id[:16].ljust(16, b'\0')) + \
+                '0'
+        return filename, None
+
+    def get_modules(self):
+        stream = self.get_stream(MODULE_LIST_STREAM)
+        if not stream:
+            return []
+        rva, size = stream
+        count, = self.unpack(UINT32, rva)
+        # Some writers align the entries after the count.
+        offset = rva + 4
+        if size == 8 + count * MODULE.size:
+            offset += 4
+        modules = []
+        for i in range(count):
+            (base, module_size, _, _, name_rva, _, cv_size, cv_rva,
+             _, _, _, _) = self.unpack(MODULE, offset + i * MODULE.size)
+            filename = basename(self.read_string(name_rva))
+            debug_file, debug_id = self.get_debug_info(cv_size, cv_rva,
+                                                       filename)
+            modules.append(Module(filename=filename,
+                                  base_addr=base,
+                                  size=module_size,
+                                  debug_file=debug_file,
+                                  debug_id=debug_id))
+        return modules
+
+    def get_info(self):
+        os_name, cpu_arch, cpu_count = self.get_system_info()
+        crash_address, instruction_pointer = self.get_exception(cpu_arch)
+        modules = self.get_modules()
+        crash_module = None
+        if instruction_pointer is not None:
+            crash_module = next(
+                (m for m in modules
+                 if m.base_addr <= instruction_pointer <
+                 m.base_addr + m.size),
+                None)
+        return MinidumpInfo(os=os_name,
+                            cpu_arch=cpu_arch,
+                            cpu_count=cpu_count,
+                            crash_address=crash_address,
+                            instruction_pointer=instruction_pointer,
+                            crash_module=crash_module,
+                            modules=modules)
+
+
+def read_minidump_info(file):
+    """
+    Read a minidump summary from a binary file object, leaving its
+    position unchanged.  Raises MinidumpError if the file is not a valid
+    minidump.
+    """
+    try:
+        buffer = file.getbuffer()
+    except AttributeError:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # Not a real file (or an empty one)
+            position = file.tell()
+            buffer = file.read()
+            file.seek(position)
+    try:
+        return MinidumpReader(buffer).get_info()
+    finally:
+        if isinstance(buffer, memoryview):
+            buffer.release()
+        elif isinstance(buffer, mmap.mmap):
+            buffer.close()
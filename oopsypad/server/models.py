@@ -1,3 +1,6 @@
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from distutils.version import LooseVersion
@@ -5,24 +8,76 @@ import hashlib
 import hmac
 import json
 import os
+import re
 import subprocess
+import zlib
 
 from flask import current_app, url_for
 from flask_mongoengine import MongoEngine, BaseQuerySet
 from flask_security import UserMixin, RoleMixin
 import mongoengine as mongo
 from mongoengine import fields
-from mongoengine.queryset.visitor import Q
 from werkzeug.utils import secure_filename
 
+from oopsypad.server import stackwalker, symbols
+from oopsypad.server.cache import TTLCache
 from oopsypad.server.config import Config
-from oopsypad.server.helpers import last_12_months
+from oopsypad.server.helpers import (format_stacktrace, get_frame_signature,
+                                     get_signature, last_12_months)
+from oopsypad.server.symindex import InvalidSymbolIndex
 
 DUMPS_DIR = Config.DUMPS_DIR
 SYMFILES_DIR = Config.SYMFILES_DIR
+UPLOAD_CHUNK_SIZE = Config.UPLOAD_CHUNK_SIZE
+REMOVE_FILES_WORKERS = 8
+# Minidump fields derived from the stackwalker output
+PROCESSING_RESULT_FIELDS = ('missing_symbols', 'crash_reason',
+                            'crash_address', 'crash_location', 'signature',
+                            'signature_hash', 'process_uptime',
+                            'crash_thread')
+# Minidump fields to leave out when listing minidumps
+LARGE_MINIDUMP_FIELDS = ('legacy_stacktrace', 'legacy_stacktrace_json')
+# Issue index by crash location, unique in versions which bucketed crashes
+# by location only
+ISSUE_LOCATION_INDEX = 'product_1_version_1_platform_1_reason_1_location_1'
 
 db = MongoEngine()
 
+ProjectPolicy = namedtuple('ProjectPolicy',
+                           ['name', 'min_version', 'allowed_platforms',
+                            'queue', 'priority'])
+
+project_policies = TTLCache()
+
+user_cache = TTLCache()
+
+
+def read_chunks(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    return iter(lambda: stream.read(chunk_size), b'')
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return e
+
+
+def drop_index(document, name, unique):
+    """
+    Drop an index of an older version which is now declared differently.
+    `unique` is the uniqueness of the old index, so that the declared one
+    is never dropped.
+    """
+    # The raw collection, as building the declared indexes first could
+    # conflict with this one.
+    collection = document._get_db()[document._get_collection_name()]
+    index = collection.index_information().get(name)
+    if index and bool(index.get('unique')) == unique:
+        collection.drop_index(name)
+
 
 class Role(mongo.Document, RoleMixin):
     name = mongo.StringField(max_length=80, unique=True)
@@ -46,7 +101,14 @@ class User(mongo.Document, UserMixin):
 
     auth_token = mongo.StringField()
 
+    meta = {
+        'indexes': [
+            'auth_token'
+        ]
+    }
+
     def save(self, *args, **kwargs):
+        user_cache.clear()
         if not self.roles:
             self.roles = [Role.objects(name='developer').first()]
         if not self.auth_token:
@@ -59,6 +121,24 @@ class User(mongo.Document, UserMixin):
 
         return super().save(**kwargs)
 
+    def delete(self, *args, **kwargs):
+        user_cache.clear()
+        return super().delete(**kwargs)
+
+    def get_role_names(self):
+        return [role.name for role in self.roles]
+
+    @classmethod
+    def get_with_roles(cls, **query):
+        """
+        Find a user with roles already dereferenced, so role checks made
+        on the returned object don't query the database again.
+        """
+        user = cls.objects(**query).first()
+        if user:
+            user.get_role_names()
+        return user
+
 
 class Minidump(mongo.Document):
     product = fields.StringField()  # Crashed application name
@@ -71,11 +151,19 @@ class Minidump(mongo.Document):
 
     minidump = fields.FileField()  # Google Breakpad minidump
 
-    file_path = fields.StringField()
+    file_path = fields.StringField()  # Local file of older versions
+
+    checksum = fields.StringField()  # SHA-256 of the minidump content
+
+    duplicates = fields.IntField(default=0)  # Identical re-uploads count
+
+    last_duplicate_date = fields.DateTimeField()
 
-    stacktrace = fields.StringField()
+    # Stacktraces of minidumps processed before they were moved to
+    # MinidumpStacktrace
+    legacy_stacktrace = fields.StringField(db_field='stacktrace')
 
-    stacktrace_json = fields.DictField()
+    legacy_stacktrace_json = fields.DictField(db_field='stacktrace_json')
 
     date_created = fields.DateTimeField()
 
@@ -85,6 +173,26 @@ class Minidump(mongo.Document):
 
     crash_location = fields.StringField()
 
+    signature = fields.StringField()  # Top frames of the crashing thread
+
+    signature_hash = fields.StringField()  # SHA-1 of the signature
+
+    # Debug IDs of the modules the stackwalker had no symbols for
+    missing_symbols = fields.ListField(fields.StringField())
+
+    # Read from the minidump when it's received, before stackwalking
+    os_name = fields.StringField()
+
+    cpu_arch = fields.StringField()
+
+    cpu_count = fields.IntField()
+
+    module_debug_ids = fields.ListField(fields.StringField())
+
+    crash_module = fields.StringField()  # Debug ID of the crashed module
+
+    crash_module_offset = fields.StringField()
+
     process_uptime = fields.IntField(default=0)
 
     crash_thread = fields.IntField()
@@ -94,9 +202,20 @@ class Minidump(mongo.Document):
             'product',
             'platform',
             'date_created',
+            'missing_symbols',
+            {'fields': ('product', 'checksum'),
+             'name': 'minidump_checksum',
+             'unique': True,
+             'partialFilterExpression': {'checksum': {'$exists': True}}},
+            ('product', 'date_created'),
             ('product', 'version'),
             ('product', 'version', 'platform', 'crash_reason'),
-            ('product', 'version', 'platform', 'crash_reason', 'crash_location')
+            ('product', 'version', 'platform', 'crash_reason',
+             'crash_location'),
+            ('product', 'version', 'platform', 'crash_reason',
+             'signature_hash'),
+            ('product', 'version', 'platform', 'crash_module',
+             'crash_module_offset')
         ],
         'ordering': ['-date_created'],
         'queryset_class': BaseQuerySet
@@ -108,117 +227,450 @@ class Minidump(mongo.Document):
                        minidump_id=str(self.minidump.grid_id))
 
     def save_minidump_file(self, minidump_file):
-        if not os.path.isdir(DUMPS_DIR):
-            os.makedirs(DUMPS_DIR)
+        """
+        Stream the minidump file into GridFS, computing its checksum on the
+        way.  The document itself isn't saved.
+        """
+        self.filename = secure_filename(minidump_file.filename)
+        if self.minidump:
+            self.minidump.delete()
+        checksum = hashlib.sha256()
+        self.minidump.new_file(content_type='application/octet-stream',
+                               filename=self.filename)
         try:
-            self.filename = secure_filename(minidump_file.filename)
-            target_path = self.get_target_minidump_path()
-            minidump_file.save(target_path)
-            with open(target_path, 'rb') as minidump:
-                if self.minidump:
-                    self.minidump.replace(minidump)
-                else:
-                    self.minidump.put(minidump)
-            self.file_path = target_path
-            self.save()
-        except Exception as e:
-            current_app.logger.exception(
-                'Cannot save minidump file: {}'.format(e))
+            for chunk in read_chunks(minidump_file.stream):
+                checksum.update(chunk)
+                self.minidump.write(chunk)
+        finally:
+            self.minidump.close()
+        self.checksum = checksum.hexdigest()
+
+    def load_stacktrace(self):
+        if getattr(self, '_stacktrace', None) is None:
+            stored = MinidumpStacktrace.objects(id=self.id).first() \
+                if self.id else None
+            if stored:
+                self._stacktrace = (stored.get_text(), stored.get_json())
+            else:
+                self._stacktrace = (self.legacy_stacktrace,
+                                    self.legacy_stacktrace_json or {})
+        return self._stacktrace
 
-    def get_target_minidump_path(self):
-        return os.path.join(DUMPS_DIR, self.filename)
+    def set_stacktrace(self, text, json_data):
+        self._stacktrace = (text, json_data)
 
-    def get_stacktrace(self):
-        minidump_path = self.file_path
-        try:
-            minidump_stackwalk_output = subprocess.check_output(
-                [Config.MINIDUMP_STACKWALK, minidump_path, SYMFILES_DIR],
-                stderr=subprocess.DEVNULL)
-            self.stacktrace = minidump_stackwalk_output.decode()
-            self.save()
-        except subprocess.CalledProcessError as e:
-            current_app.logger.exception(
-                'Cannot get stacktrace: {}'.format(e))
+    @property
+    def stacktrace(self):
+        return self.load_stacktrace()[0]
 
-    def parse_process_uptime(self):
-        line_start = 'Process uptime: '
-        stacktrace_lines = self.stacktrace.split('\n')
+    @property
+    def stacktrace_json(self):
+        return self.load_stacktrace()[1]
+
+    @classmethod
+    def prefetch_stacktraces(cls, minidumps):
+        """
+        Load stacktraces of several minidumps with a single query.
+        """
+        minidumps = [m for m in minidumps
+                     if getattr(m, '_stacktrace', None) is None]
+        stored = {s.id: s for s in MinidumpStacktrace.objects(
+            id__in=[m.id for m in minidumps])}
+        for minidump in minidumps:
+            if minidump.id in stored:
+                minidump.set_stacktrace(stored[minidump.id].get_text(),
+                                        stored[minidump.id].get_json())
+
+    def get_target_minidump_path(self):
+        # Unique per process, as the same minidump may be walked by several
+        # workers of the host at once.
+        return os.path.join(DUMPS_DIR, '{}_{}_{}'.format(
+            self.id, os.getpid(), self.filename))
+
+    @contextmanager
+    def local_minidump(self):
+        """
+        Provide a local path of the minidump for the stackwalker.
+
+        Files stored by older versions are used in place. Otherwise the
+        minidump is fetched from GridFS, which is the source of truth, and
+        the local copy is removed once it's walked.
+        """
+        if self.file_path and os.path.isfile(self.file_path):
+            yield self.file_path
+            return
+        target_path = self.get_target_minidump_path()
+        os.makedirs(DUMPS_DIR, exist_ok=True)
         try:
-            process_uptime_line = list(
-                filter(lambda line: str.startswith(line, line_start),
-                       stacktrace_lines))[0]
-            raw_uptime = process_uptime_line.replace(line_start, '')
-
-            if 'not available' not in raw_uptime.lower():
-                if 'seconds' in raw_uptime:
-                    uptime_seconds = int(raw_uptime.split()[0])
-                else:
-                    days, raw_hms = raw_uptime.split(' days ')
-                    hms = datetime.strptime(raw_hms, '%H:%M:%S.%f')
-                    uptime_seconds = timedelta(
-                        days=int(days), hours=hms.hour, minutes=hms.minute,
-                        seconds=hms.second).total_seconds()
-                self.process_uptime = uptime_seconds
-            self.save()
-        except Exception as e:
-            current_app.logger.exception(
-                'Cannot parse process uptime: {}'.format(e))
+            with open(target_path, 'wb') as f:
+                for chunk in read_chunks(self.minidump.get()):
+                    f.write(chunk)
+            yield target_path
+        finally:
+            e = remove_file(target_path)
+            if e:
+                current_app.logger.error(
+                    'Cannot remove minidump: {}'.format(e))
+
+    def run_stackwalker(self, minidump_path):
+        symbols_url = current_app.config['STACKWALKER_SYMBOLS_URL']
+        if current_app.config['STACKWALKER_SERVER']:
+            return stackwalker.walk_minidump(
+                minidump_path, [SYMFILES_DIR],
+                current_app.config['STACKWALKER_CACHE_MODULES'],
+                current_app.config['STACKWALKER_CACHE_SIZE'],
+                symbols_url)
+        stackwalker_output = subprocess.check_output(
+            [Config.STACKWALKER] +
+            stackwalker.get_symbols_url_args(symbols_url) +
+            [minidump_path, SYMFILES_DIR],
+            stderr=subprocess.DEVNULL)
+        return json.loads(stackwalker_output.decode())
 
     def parse_stacktrace(self):
-        minidump_path = self.file_path
+        crash_info = self.stacktrace_json.get('crash_info')
+        if not crash_info:
+            current_app.logger.error(
+                'Cannot parse stacktrace: No crash info provided.')
+            return False
+
+        self.crash_reason = crash_info.get('type').split()[0]
+        self.crash_address = crash_info.get('address')
+        self.crash_thread = crash_info.get('crashing_thread')
+        self.process_uptime = self.stacktrace_json.get('process_uptime', 0)
+
+        crashing_thread = self.stacktrace_json.get('crashing_thread')
+        frames = crashing_thread.get('frames')
+        frame = frames[0]
+        module = frame.get('module')
+        module_offset = frame.get('module_offset')
+        if module and module_offset:
+            self.crash_location = '{} + {}'.format(module, module_offset)
+        else:
+            self.crash_location = self.crash_address
+
+        self.signature = get_signature(
+            frames,
+            current_app.config['SIGNATURE_FRAMES'],
+            current_app.config['SIGNATURE_IRRELEVANT_FRAMES'],
+            current_app.config['SIGNATURE_PREFIX_FRAMES']
+        ) or self.crash_location
+        self.signature_hash = hashlib.sha1(
+            self.signature.encode('utf8')).hexdigest()
+        return True
+
+    def save_processing_results(self):
+        MinidumpStacktrace.store(self.id, self.stacktrace,
+                                 self.stacktrace_json)
+        # A single $set of the derived fields instead of saving the whole
+        # document.
+        self.update(unset__legacy_stacktrace=True,
+                    unset__legacy_stacktrace_json=True,
+                    **{'set__{}'.format(field): getattr(self, field)
+                       for field in PROCESSING_RESULT_FIELDS})
+
+    def process(self):
+        """
+        Process a new minidump. Depending on the configuration the
+        stackwalk is deferred until the symfile of the crashed module is
+        uploaded, or skipped if the same crash was already processed.
+        """
+        if current_app.config['DEFER_WITHOUT_SYMBOLS'] and \
+                self.defer_without_symbols():
+            return
+        if current_app.config['SKIP_KNOWN_CRASHES'] and \
+                self.copy_known_crash():
+            return
+        self.process_stacktrace()
+
+    def defer_without_symbols(self):
+        if not self.crash_module or \
+                Symfile.objects(symfile_id=self.crash_module).first():
+            return False
+        # Processed when the symfile is uploaded, see Symfile.create_symfile
+        self.update(set__missing_symbols=[self.crash_module])
+        return True
+
+    def crashed_in_shared_frame(self):
+        """
+        Whether the minidump crashed in a frame shared by crashes of
+        different signatures: an irrelevant or a prefix one (e.g. abort or
+        malloc), see SIGNATURE_IRRELEVANT_FRAMES.
+        """
+        crashing_thread = self.stacktrace_json.get('crashing_thread') or {}
+        frames = crashing_thread.get('frames')
+        if not frames:
+            return False
+        name = get_frame_signature(frames[0])
+        patterns = current_app.config['SIGNATURE_IRRELEVANT_FRAMES'] + \
+            current_app.config['SIGNATURE_PREFIX_FRAMES']
+        return any(re.search(pattern, name) for pattern in patterns)
+
+    def copy_known_crash(self):
+        """
+        Take the crash info of an already processed minidump which crashed
+        at the same module offset, without a stacktrace of its own.
+
+        Crashes in irrelevant or prefix frames (see crashed_in_shared_frame)
+        are walked instead, as their signature depends on the callers.  A
+        known minidump without a stacktrace was copied from one which
+        passed this check.
+        """
+        if not self.crash_module:
+            return False
+        known = Minidump.objects(
+            product=self.product,
+            version=self.version,
+            platform=self.platform,
+            crash_module=self.crash_module,
+            crash_module_offset=self.crash_module_offset,
+            signature_hash__ne=None,
+            id__ne=self.id
+        ).exclude(*LARGE_MINIDUMP_FIELDS).first()
+        if not known or known.crashed_in_shared_frame():
+            return False
+
+        for field in ('crash_reason', 'crash_location', 'crash_thread',
+                      'signature', 'signature_hash'):
+            setattr(self, field, getattr(known, field))
+        self.update(set__crash_reason=self.crash_reason,
+                    set__crash_location=self.crash_location,
+                    set__crash_thread=self.crash_thread,
+                    set__signature=self.signature,
+                    set__signature_hash=self.signature_hash,
+                    unset__process_uptime=True)
+        Issue.create_or_update_issue(product=self.product,
+                                     version=self.version,
+                                     platform=self.platform,
+                                     reason=self.crash_reason,
+                                     location=self.crash_location,
+                                     signature=self.signature,
+                                     signature_hash=self.signature_hash,
+                                     date_created=self.date_created,
+                                     process_uptime=None)
+        return True
+
+    def prefetch_symbols(self):
+        """
+        Fetch symfiles of the minidump modules.  Returns True if any of
+        them was fetched.
+        """
+        fetched = [symbols.fetch_symfile(symfile) for symfile in
+                   Symfile.objects(symfile_id__in=self.module_debug_ids)]
+        return any(fetched)
+
+    def get_missing_symbols(self):
+        return symbols.get_missing_debug_ids(self.stacktrace_json)
+
+    @staticmethod
+    def fetch_missing_symbols(stacktrace_json):
+        """
+        Fetch symfiles the stackwalker didn't find locally but which were
+        uploaded, e.g. through another node.  Returns True if any of them
+        was fetched.
+        """
+        symbols.touch_loaded_symfiles(stacktrace_json)
+        missing = symbols.get_missing_debug_ids(stacktrace_json)
+        if not missing:
+            return False
+        fetched = [symbols.fetch_symfile(symfile) for symfile in
+                   Symfile.objects(symfile_id__in=missing)]
+        return any(fetched)
+
+    @staticmethod
+    def trim_symbols_cache():
+        if current_app.config['SYMBOLS_CACHE_SIZE']:
+            symbols.trim_cache(current_app.config['SYMBOLS_CACHE_SIZE'],
+                               Symfile.get_fetchable_paths)
+
+    @staticmethod
+    def symbolicate_frames(stacktrace_json):
+        """
+        Fill function, file and line of frames the stackwalker had no
+        symbols for from the symfile indexes.
+        """
+        frames = symbols.get_unsymbolicated_frames(stacktrace_json)
+        if not frames:
+            return
+        for symfile in Symfile.objects(symfile_id__in=list(frames),
+                                       symindex__exists=True):
+            index_path = symbols.fetch_symindex(symfile)
+            if not index_path:
+                continue
+            try:
+                symbols.symbolicate_frames(frames[symfile.symfile_id],
+                                           index_path)
+            except InvalidSymbolIndex as e:
+                # Index of an older format, see build-symbol-indexes. Drop
+                # the local copy so that a rebuilt one is fetched next time.
+                current_app.logger.warning(
+                    'Cannot use symfile index: {}'.format(e))
+                os.remove(index_path)
+
+    def get_issue(self):
+        issues = Issue.objects(product=self.product,
+                               version=self.version,
+                               platform=self.platform,
+                               reason=self.crash_reason)
+        if self.signature_hash:
+            return issues.filter(signature_hash=self.signature_hash).first()
+        return issues.filter(location=self.crash_location,
+                             signature_hash=None).first()
+
+    def process_stacktrace(self):
+        """
+        Walk the minidump once and derive the stacktrace text, its JSON
+        representation, crash info and process uptime from that single run.
+
+        A minidump that has been processed before is moved to the issue
+        matching its new stacktrace, the previous issue is updated or
+        removed if it's left empty.
+        """
         try:
-            stackwalker_output = subprocess.check_output(
-                [Config.STACKWALKER, '--pretty', minidump_path, SYMFILES_DIR],
-                stderr=subprocess.DEVNULL)
-
-            self.stacktrace_json = json.loads(stackwalker_output.decode())
-            crash_info = self.stacktrace_json.get('crash_info')
-            if not crash_info:
-                current_app.logger.error(
-                    'Cannot parse stacktrace: No crash info provided.')
+            previous_issue = self.get_issue() if self.crash_reason else None
+            fetched = False
+            if current_app.config['FETCH_SYMFILES'] and \
+                    current_app.config['PREFETCH_SYMBOLS']:
+                fetched = self.prefetch_symbols()
+            with self.local_minidump() as minidump_path:
+                stacktrace_json = self.run_stackwalker(minidump_path)
+                if current_app.config['FETCH_SYMFILES'] and \
+                        self.fetch_missing_symbols(stacktrace_json):
+                    fetched = True
+                    stacktrace_json = self.run_stackwalker(minidump_path)
+            if fetched:
+                self.trim_symbols_cache()
+            if current_app.config['SYMINDEX_LOOKUP']:
+                self.symbolicate_frames(stacktrace_json)
+            self.set_stacktrace(format_stacktrace(stacktrace_json),
+                                stacktrace_json)
+            self.missing_symbols = self.get_missing_symbols()
+            parsed = self.parse_stacktrace()
+            self.save_processing_results()
+            if not parsed:
+                return
+            if previous_issue and \
+                    previous_issue.reason == self.crash_reason and \
+                    previous_issue.signature_hash == self.signature_hash:
                 return
-
-            self.crash_reason = crash_info.get('type').split()[0]
-            self.crash_address = crash_info.get('address')
-            self.crash_thread = crash_info.get('crashing_thread')
-
-            crashing_thread = self.stacktrace_json.get('crashing_thread')
-            frame = crashing_thread.get('frames')[0]
-            module = frame.get('module')
-            module_offset = frame.get('module_offset')
-            if module and module_offset:
-                self.crash_location = '{} + {}'.format(module, module_offset)
-            else:
-                self.crash_location = self.crash_address
-            self.save()
-
-            self.parse_process_uptime()
 
             Issue.create_or_update_issue(product=self.product,
                                          version=self.version,
                                          platform=self.platform,
                                          reason=self.crash_reason,
-                                         location=self.crash_location)
+                                         location=self.crash_location,
+                                         signature=self.signature,
+                                         signature_hash=self.signature_hash,
+                                         date_created=self.date_created,
+                                         process_uptime=self.process_uptime)
+            if previous_issue:
+                previous_issue.update_or_delete()
         except (subprocess.CalledProcessError, IndexError) as e:
             current_app.logger.exception(
-                'Cannot parse stacktrace: {}'.format(e))
+                'Cannot process stacktrace: {}'.format(e))
+
+    def get_processing_options(self):
+        policy = Project.get_cached_policy(self.product)
+        options = {'queue': current_app.config['CRASH_REPORT_QUEUE']}
+        if policy and policy.queue:
+            options['queue'] = policy.queue
+        if policy and policy.priority is not None:
+            options['priority'] = policy.priority
+        return options
 
     def create_stacktrace(self):
         from oopsypad.server.worker import process_minidump
-        process_minidump.delay(str(self.id))
+        process_minidump.apply_async(args=[str(self.id)],
+                                     **self.get_processing_options())
+
+    @classmethod
+    def create_stacktraces(cls, minidumps):
+        """
+        Schedule processing of several minidumps as a single Celery group.
+        """
+        from celery import group
+        from oopsypad.server.worker import process_minidump
+        group(process_minidump.signature((str(minidump.id),),
+                                         **minidump.get_processing_options())
+              for minidump in minidumps).apply_async()
 
     def remove_minidump(self):
-        if self.file_path:
-            if os.path.isfile(self.file_path):
-                try:
-                    os.remove(self.file_path)
-                except OSError as e:
-                    current_app.logger.exception(
+        type(self).remove_minidumps([{'_id': self.id,
+                                      'minidump': self.minidump.grid_id,
+                                      'file_path': self.file_path}])
+
+    @classmethod
+    def remove_minidumps(cls, minidumps):
+        """
+        Remove minidumps given as raw documents (with at least _id, minidump
+        and file_path) together with their GridFS and local files.
+        """
+        grid_ids = [m['minidump'] for m in minidumps if m.get('minidump')]
+        if grid_ids:
+            fs = cls._get_db()[cls._fields['minidump'].collection_name]
+            fs.files.delete_many({'_id': {'$in': grid_ids}})
+            fs.chunks.delete_many({'files_id': {'$in': grid_ids}})
+
+        file_paths = [m['file_path'] for m in minidumps if m.get('file_path')]
+        with ThreadPoolExecutor(max_workers=REMOVE_FILES_WORKERS) as executor:
+            for e in executor.map(remove_file, file_paths):
+                if e:
+                    current_app.logger.error(
                         'Cannot remove minidump: {}'.format(e))
-        if self.minidump:
-            self.minidump.delete()
-            self.save()
-        self.delete()
+
+        ids = [m['_id'] for m in minidumps]
+        MinidumpStacktrace.objects(id__in=ids).delete()
+        cls.objects(id__in=ids).delete()
+
+    @classmethod
+    def purge(cls, minidumps, batch_size=1000, progress=None):
+        """
+        Remove all minidumps of the queryset batch by batch.
+
+        `progress`, if given, is called with the number of minidumps removed
+        so far after each batch.  Returns the number of removed minidumps.
+        """
+        removed = 0
+        while True:
+            batch = list(minidumps.only('minidump', 'file_path')
+                         .limit(batch_size).as_pymongo())
+            if not batch:
+                return removed
+            cls.remove_minidumps(batch)
+            removed += len(batch)
+            if progress:
+                progress(removed)
+
+    @classmethod
+    def get_legacy_stacktrace_minidumps(cls):
+        return cls.objects(mongo.Q(legacy_stacktrace__exists=True) |
+                           mongo.Q(legacy_stacktrace_json__exists=True))
+
+    @classmethod
+    def migrate_stacktraces(cls, batch_size=100, progress=None):
+        """
+        Move stacktraces stored in minidump documents to MinidumpStacktrace.
+
+        `progress`, if given, is called with the number of minidumps
+        migrated in each batch.  Returns the number of migrated minidumps.
+        """
+        minidumps = cls.get_legacy_stacktrace_minidumps().only(
+            'id', 'legacy_stacktrace', 'legacy_stacktrace_json')
+        migrated = 0
+        while True:
+            batch = list(minidumps.limit(batch_size))
+            if not batch:
+                return migrated
+            for minidump in batch:
+                MinidumpStacktrace.store(minidump.id,
+                                         minidump.legacy_stacktrace,
+                                         minidump.legacy_stacktrace_json)
+            cls.objects(id__in=[m.id for m in batch]).update(
+                unset__legacy_stacktrace=True,
+                unset__legacy_stacktrace_json=True)
+            migrated += len(batch)
+            if progress:
+                progress(len(batch))
 
     def get_time(self):
         return self.date_created.strftime('%d-%m-%Y %H:%M')
@@ -228,37 +680,87 @@ class Minidump(mongo.Document):
         return cls.objects(id=minidump_id).first()
 
     @classmethod
-    def create_minidump(cls, product, version, platform, minidump_file):
+    def get_duplicate(cls, product, checksum):
+        return cls.objects(product=product, checksum=checksum).first()
+
+    @classmethod
+    def create_minidump(cls, product, version, platform, minidump_file,
+                        minidump_info=None):
+        """
+        Store the uploaded minidump and schedule its processing.
+        """
+        minidump, created = cls.store_minidump(product, version, platform,
+                                               minidump_file, minidump_info)
+        if created:
+            minidump.create_stacktrace()
+        return minidump
+
+    @classmethod
+    def store_minidump(cls, product, version, platform, minidump_file,
+                       minidump_info=None):
+        """
+        Store the uploaded minidump and return it along with whether it's a
+        new one, which has to be processed.
+
+        Minidumps are content-addressed: if the same payload was already
+        received for the product (client retries, crash loops resending the
+        same file) the stored one is reused and only its duplicates counter
+        is incremented, so neither the document nor the stackwalk is
+        repeated.  The checksum is computed while the upload is streamed
+        into GridFS, the new blob is removed if it's a duplicate.
+        """
         minidump = cls(product=product,
                        version=version,
                        platform=platform,
                        date_created=datetime.now())
-
+        if minidump_info:
+            minidump.set_minidump_info(minidump_info)
         minidump.save_minidump_file(minidump_file)
-        minidump.create_stacktrace()
-        return minidump
 
-    @classmethod
-    def get_last_12_months_minidumps_counts(cls, queryset):
-        today = datetime.today().replace(day=1)
-        counts = []
-        for months in last_12_months():
-            months_ago = today - relativedelta(months=months)
-            one_more_months_ago = today - relativedelta(months=months - 1)
-            months_ago_minidumps_count = queryset.filter(
-                Q(date_created__lte=one_more_months_ago)
-                & Q(date_created__gte=months_ago)).count()
-            counts.append(months_ago_minidumps_count)
-        return counts
+        duplicate = cls.get_duplicate(product, minidump.checksum)
+        if not duplicate:
+            try:
+                minidump.save()
+            except mongo.NotUniqueError:
+                # Another request has just stored the same minidump.
+                duplicate = cls.get_duplicate(product, minidump.checksum)
+            except Exception:
+                minidump.minidump.delete()
+                raise
+        if duplicate:
+            minidump.minidump.delete()
+            duplicate.update(inc__duplicates=1,
+                             set__last_duplicate_date=datetime.now())
+            return duplicate, False
+
+        CrashCounter.increment(product=product,
+                               version=version,
+                               platform=platform,
+                               date=minidump.date_created)
+        return minidump, True
+
+    def set_minidump_info(self, info):
+        self.os_name = info.os
+        self.cpu_arch = info.cpu_arch
+        self.cpu_count = info.cpu_count
+        self.module_debug_ids = [m.debug_id for m in info.modules
+                                 if m.debug_id]
+        if info.crash_address is not None:
+            self.crash_address = hex(info.crash_address)
+        if info.crash_module and info.crash_module.debug_id:
+            self.crash_module = info.crash_module.debug_id
+            self.crash_module_offset = hex(info.instruction_pointer -
+                                           info.crash_module.base_addr)
 
     @classmethod
     def get_versions_per_product(cls, product):
-        versions = cls.objects(product=product).distinct('version')
+        versions = CrashCounter.objects(product=product).distinct('version')
         return sorted(versions, key=LooseVersion)
 
     @classmethod
     def get_last_n_project_minidumps(cls, n, project_name):
-        project_minidumps = cls.objects(product=project_name)
+        project_minidumps = cls.objects(product=project_name).exclude(
+            *LARGE_MINIDUMP_FIELDS)
         return project_minidumps[:n]
 
     def __str__(self):
@@ -268,6 +770,149 @@ class Minidump(mongo.Document):
                                               self.filename)
 
 
+class CrashCounter(mongo.Document):
+    """
+    Daily number of crash reports received per product version and platform.
+    """
+    product = fields.StringField(required=True)
+
+    version = fields.StringField(required=True)
+
+    platform = fields.StringField(required=True)
+
+    day = fields.DateTimeField(required=True)
+
+    count = fields.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ('product', 'version', 'platform', 'day'),
+             'unique': True},
+            ('product', 'day')
+        ]
+    }
+
+    @staticmethod
+    def get_day(date):
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def increment(cls, product, version, platform, date):
+        counters = cls.objects(product=product,
+                               version=version,
+                               platform=platform,
+                               day=cls.get_day(date))
+        try:
+            counters.update_one(upsert=True, inc__count=1)
+        except mongo.NotUniqueError:
+            # Another request has just inserted the same counter.
+            counters.update_one(inc__count=1)
+
+    @classmethod
+    def get_last_12_months_counts(cls, product, platforms, version=None):
+        """
+        Sum product crash reports per platform for each of the last 12
+        months (oldest first).
+        """
+        start = cls.get_day(datetime.today().replace(day=1)) - \
+            relativedelta(months=max(last_12_months()))
+        months = [(start + relativedelta(months=i)).strftime('%Y-%m')
+                  for i in range(len(last_12_months()))]
+
+        counters = cls.objects(product=product,
+                               platform__in=platforms,
+                               day__gte=start)
+        if version:
+            counters = counters.filter(version=version)
+        results = counters.aggregate({
+            '$group': {
+                '_id': {
+                    'platform': '$platform',
+                    'month': {'$dateToString': {'format': '%Y-%m',
+                                                'date': '$day'}}
+                },
+                'count': {'$sum': '$count'}
+            }
+        })
+
+        counts = OrderedDict((platform, [0] * len(months))
+                             for platform in platforms)
+        for result in results:
+            platform, month = result['_id']['platform'], result['_id']['month']
+            if month in months:
+                counts[platform][months.index(month)] = result['count']
+        return counts
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recreate all counters from the stored minidumps.
+
+        Reports received while the counters are rebuilt may be lost, so this
+        is meant to be run with crash report ingestion stopped.
+        """
+        results = Minidump.objects().aggregate({
+            '$group': {
+                '_id': {
+                    'product': '$product',
+                    'version': '$version',
+                    'platform': '$platform',
+                    'day': {'$dateToString': {'format': '%Y-%m-%d',
+                                              'date': '$date_created'}}
+                },
+                'count': {'$sum': 1}
+            }
+        })
+        counters = [cls(product=result['_id']['product'],
+                        version=result['_id']['version'],
+                        platform=result['_id']['platform'],
+                        day=datetime.strptime(result['_id']['day'],
+                                              '%Y-%m-%d'),
+                        count=result['count'])
+                    for result in results]
+        cls.objects().delete()
+        if counters:
+            cls.objects.insert(counters, load_bulk=False)
+        return len(counters)
+
+    def __str__(self):
+        return 'CrashCounter: {} {} {} {} {}'.format(
+            self.product, self.version, self.platform,
+            self.day.strftime('%d-%m-%Y'), self.count)
+
+
+class MinidumpStacktrace(mongo.Document):
+    """
+    zlib compressed stackwalker output of a minidump, kept out of the
+    minidump documents so that listing them stays cheap.
+    """
+    id = fields.ObjectIdField(primary_key=True)  # Minidump id
+
+    compressed_text = fields.BinaryField()
+
+    compressed_json = fields.BinaryField()
+
+    def get_text(self):
+        if self.compressed_text is None:
+            return None
+        return zlib.decompress(self.compressed_text).decode('utf8')
+
+    def get_json(self):
+        if self.compressed_json is None:
+            return {}
+        return json.loads(zlib.decompress(self.compressed_json).decode('utf8'))
+
+    @classmethod
+    def store(cls, minidump_id, text, json_data):
+        compressed_text = zlib.compress(text.encode('utf8')) \
+            if text is not None else None
+        compressed_json = zlib.compress(json.dumps(json_data or {}).encode(
+            'utf8'))
+        cls(id=minidump_id,
+            compressed_text=compressed_text,
+            compressed_json=compressed_json).save()
+
+
 class Symfile(mongo.Document):
     product = fields.StringField()
 
@@ -281,6 +926,8 @@ class Symfile(mongo.Document):
 
     symfile = fields.FileField(required=True)
 
+    symindex = fields.FileField()  # See oopsypad.server.symindex
+
     date_created = fields.DateTimeField()
 
     meta = {
@@ -305,14 +952,74 @@ class Symfile(mongo.Document):
         except Exception as e:
             current_app.logger.exception(
                 'Cannot save symfile: {}'.format(e))
+            return
+        # Also for symfiles uploaded through the admin
+        self.create_symindex()
+        self.reprocess_minidumps()
+
+    def create_symindex(self):
+        """
+        Build the symfile index in background, it takes seconds for large
+        symfiles.
+        """
+        from oopsypad.server.worker import build_symindex
+        build_symindex.apply_async(
+            args=[str(self.id)], queue=current_app.config['REPROCESS_QUEUE'])
+
+    def build_symindex(self):
+        symbols.fetch_symfile(self)
+        self.save_symindex(symbols.get_local_symfile_path(self))
+        self.save()
 
-    def get_symfile_path(self):
+    def save_symindex(self, symfile_path):
+        try:
+            index_path = symbols.create_symindex(symfile_path)
+            if self.symindex:
+                self.symindex.delete()
+            with open(index_path, 'rb') as file:
+                self.symindex.put(file,
+                                  content_type='application/octet-stream',
+                                  filename=os.path.basename(index_path))
+        except Exception as e:
+            # The symfile is still usable by the stackwalker.
+            current_app.logger.exception(
+                'Cannot create symfile index: {}'.format(e))
+
+    @classmethod
+    def get_fetchable_paths(cls, paths):
+        """
+        Return the local paths among `paths` of symfiles and indexes which
+        are stored in the database.
+        """
+        debug_ids = {os.path.basename(os.path.dirname(path))
+                     for path in paths}
+        fetchable = set()
+        for symfile in cls.objects(symfile_id__in=list(debug_ids)).only(
+                'product', 'platform', 'symfile_id', 'symfile_name',
+                'symindex'):
+            fetchable.add(symbols.get_local_symfile_path(symfile))
+            if symfile.symindex:
+                fetchable.add(symbols.get_local_symindex_path(symfile))
+        return fetchable.intersection(paths)
+
+    def get_debug_file(self):
         if str(self.platform).lower() == "windows":
-            product_name = "%s.pdb" % self.product
-        else:
-            product_name = self.product
-        
-        return os.path.join(SYMFILES_DIR, product_name, self.symfile_id)
+            return "%s.pdb" % self.product
+        return self.product
+
+    def get_sym_file_name(self):
+        """
+        Symfile name requested by the stackwalker: the debug file name
+        without the .pdb extension, with .sym.
+        """
+        debug_file = self.get_debug_file()
+        if debug_file.lower().endswith('.pdb'):
+            debug_file = debug_file[:-len('.pdb')]
+        return '{}.sym'.format(debug_file)
+
+    def get_symfile_path(self):
+        return os.path.join(SYMFILES_DIR, self.get_debug_file(),
+                            self.symfile_id)
 
     @classmethod
     def create_symfile(cls, product, version, platform, symfile_id, file):
@@ -326,6 +1033,14 @@ class Symfile(mongo.Document):
             symfile.save_symfile(file)
         return symfile
 
+    def reprocess_minidumps(self):
+        """
+        Reprocess in background the minidumps which were walked without
+        this symfile.
+        """
+        from oopsypad.server.worker import reprocess_missing_symbols
+        reprocess_missing_symbols.delay(self.symfile_id)
+
     def save(self, *args, **kwargs):
         if not self.date_created:
             self.date_created = datetime.now()
@@ -341,6 +1056,14 @@ class Symfile(mongo.Document):
 class Platform(mongo.Document):
     name = fields.StringField(required=True, unique=True)
 
+    def save(self, *args, **kwargs):
+        project_policies.clear()
+        return super().save(**kwargs)
+
+    def delete(self, *args, **kwargs):
+        project_policies.clear()
+        return super().delete(**kwargs)
+
     @classmethod
     def create_platform(cls, name):
         platform = Platform.objects(name=name).first()
@@ -363,6 +1086,16 @@ class Project(mongo.Document):
 
     allowed_platforms = fields.ListField(fields.ReferenceField(Platform))
 
+    retention_days = fields.IntField(min_value=0)  # Max minidump age
+
+    retention_max_per_issue = fields.IntField(min_value=0)
+
+    retention_keep_samples = fields.IntField(min_value=0, default=0)
+
+    queue = fields.StringField()  # Celery queue for the project crashes
+
+    priority = fields.IntField(min_value=0, max_value=9)  # 0 is the highest
+
     meta = {
         'indexes': [
             'name'
@@ -372,6 +1105,63 @@ class Project(mongo.Document):
     def get_allowed_platforms(self):
         return [i.name for i in self.allowed_platforms]
 
+    def get_policy(self):
+        return ProjectPolicy(name=self.name,
+                             min_version=self.min_version,
+                             allowed_platforms=self.get_allowed_platforms(),
+                             queue=self.queue,
+                             priority=self.priority)
+
+    @classmethod
+    def get_cached_policy(cls, name):
+        """
+        Return the crash report policy of the project (None if there's no
+        such project), cached in the process for PROJECT_CACHE_TTL seconds.
+        """
+        def load_policy():
+            project = cls.objects(name=name).first()
+            return project.get_policy() if project else None
+
+        return project_policies.get_or_load(
+            name, load_policy, current_app.config['PROJECT_CACHE_TTL'])
+
+    def save(self, *args, **kwargs):
+        project_policies.clear()
+        return super().save(**kwargs)
+
+    def delete(self, *args, **kwargs):
+        project_policies.clear()
+        return super().delete(**kwargs)
+
+    def apply_retention_policy(self):
+        """
+        Remove project minidumps older than `retention_days` or exceeding
+        `retention_max_per_issue` per issue, always keeping the newest
+        `retention_keep_samples` minidumps of each issue.
+        Returns the number of removed minidumps.
+        """
+        if not (self.retention_days or self.retention_max_per_issue):
+            return 0
+
+        older_than = None
+        if self.retention_days:
+            older_than = datetime.now() - timedelta(days=self.retention_days)
+
+        removed = 0
+        for issue in Issue.objects(product=self.name):
+            removed += issue.purge_minidumps(
+                older_than=older_than,
+                max_count=self.retention_max_per_issue,
+                keep=self.retention_keep_samples)
+
+        if older_than:
+            # Minidumps that could not be processed belong to no issue.
+            removed += Minidump.purge(Minidump.objects(
+                product=self.name,
+                crash_reason=None,
+                date_created__lt=older_than))
+        return removed
+
     def update_min_version(self, version):
         self.min_version = version
         self.save()
@@ -415,71 +1205,169 @@ class Issue(mongo.Document):
 
     location = fields.StringField()
 
+    signature = fields.StringField()
+
+    signature_hash = fields.StringField()
+
     total = fields.IntField(default=1)
 
+    first_seen = fields.DateTimeField()
+
+    last_seen = fields.DateTimeField()
+
+    uptime_sum = fields.IntField(default=0)
+
+    uptime_count = fields.IntField(default=0)
+
     meta = {
         'indexes': [
             'product',
-            ('product', 'version', 'platform', 'reason', 'location')
+            ('product', 'version', 'platform', 'reason', 'location'),
+            {'fields': ('product', 'version', 'platform', 'reason',
+                        'signature_hash'),
+             'unique': True,
+             'partialFilterExpression': {'signature_hash': {'$exists': True}}}
         ],
         'ordering': ['-total']
     }
 
-    @property
-    def last_seen(self):
-        minidump = self.get_minidumps().only('date_created').order_by(
-            '-date_created').first()
-        if minidump:
-            return minidump.date_created
+    @classmethod
+    def drop_legacy_indexes(cls):
+        """
+        Drop the crash location index if it's a unique one: it would
+        prevent crashes at the same location with different signatures
+        from making separate issues.  The non-unique one is kept.
+        """
+        drop_index(cls, ISSUE_LOCATION_INDEX, unique=True)
 
     @property
     def avg_uptime(self):
-        minidumps = self.get_minidumps().filter(process_uptime__exists=True)
-        if minidumps:
-            return int(minidumps.average('process_uptime'))
+        if self.uptime_count:
+            return int(self.uptime_sum / self.uptime_count)
         return 0
 
-    def resolve_issue(self):
-        minidumps = self.get_minidumps()
-        for minidump in minidumps:
-            minidump.remove_minidump()
-        self.delete()
+    def update_stats(self):
+        """
+        Recalculate the denormalized statistics from the issue minidumps.
+        """
+        stats = list(self.get_minidumps().aggregate({
+            '$group': {
+                '_id': None,
+                'total': {'$sum': 1},
+                'first_seen': {'$min': '$date_created'},
+                'last_seen': {'$max': '$date_created'},
+                'uptime_sum': {'$sum': '$process_uptime'},
+                # Minidumps without a stacktrace have no uptime.
+                'uptime_count': {'$sum': {'$cond': [
+                    {'$gt': ['$process_uptime', None]}, 1, 0]}}
+            }
+        }))
+        if not stats:
+            return
+        stats = stats[0]
+        self.update(set__total=stats['total'],
+                    set__first_seen=stats['first_seen'],
+                    set__last_seen=stats['last_seen'],
+                    set__uptime_sum=stats['uptime_sum'],
+                    set__uptime_count=stats['uptime_count'])
+        self.reload()
+
+    def resolve_issue(self, progress=None):
+        """
+        Remove the issue minidumps batch by batch and then the issue itself.
+
+        `progress`, if given, is called with the numbers of removed and
+        total minidumps after each batch.  Minidumps received after the
+        resolution has started are kept along with the issue.
+        """
+        minidumps = self.get_minidumps().filter(
+            date_created__lte=datetime.now())
+        total = minidumps.count()
+
+        def report_progress(removed):
+            if progress:
+                progress(removed, total)
+
+        Minidump.purge(minidumps, progress=report_progress)
+        self.update_or_delete()
+
+    def purge_minidumps(self, older_than=None, max_count=None, keep=0):
+        """
+        Remove minidumps created before `older_than` and those exceeding
+        `max_count`, except the newest `keep` ones.
+        Returns the number of removed minidumps.
+        """
+        minidumps = self.get_minidumps().order_by('-date_created')
+        removed = 0
+        if max_count:
+            removed += Minidump.purge(minidumps.skip(max(max_count, keep)))
+        if older_than:
+            samples = [m.id for m in minidumps.only('id').limit(keep)] \
+                if keep else []
+            removed += Minidump.purge(minidumps.filter(
+                date_created__lt=older_than, id__nin=samples))
+        if removed:
+            self.update_or_delete()
+        return removed
+
+    def update_or_delete(self):
+        if self.get_minidumps().count():
+            self.update_stats()
+        else:
+            self.delete()
 
     def get_minidumps(self):
         minidumps = Minidump.objects(
             product=self.product,
             version=self.version,
             platform=self.platform,
-            crash_reason=self.reason,
-            crash_location=self.location
+            crash_reason=self.reason
         )
-        return minidumps
+        if self.signature_hash:
+            return minidumps.filter(signature_hash=self.signature_hash)
+        # Issues created before signatures were introduced, their minidumps
+        # processed since then belong to signature issues.
+        return minidumps.filter(crash_location=self.location,
+                                signature_hash=None)
 
     @classmethod
     def create_or_update_issue(cls, product, version, platform, reason,
-                               location):
-        issue = cls.objects(product=product,
-                            version=version,
-                            platform=platform,
-                            reason=reason,
-                            location=location).first()
-        if issue:
-            issue.total += 1
-        else:
-            issue = cls(product=product,
-                        version=version,
-                        platform=platform,
-                        reason=reason,
-                        location=location)
-        issue.save()
-        return issue
+                               location, signature, signature_hash,
+                               date_created, process_uptime=0):
+        issues = cls.objects(product=product,
+                             version=version,
+                             platform=platform,
+                             reason=reason,
+                             signature_hash=signature_hash)
+        # Minidumps without a stacktrace have no uptime.
+        update = dict(set_on_insert__location=location,
+                      set_on_insert__signature=signature,
+                      inc__total=1,
+                      inc__uptime_sum=process_uptime or 0,
+                      inc__uptime_count=int(process_uptime is not None),
+                      min__first_seen=date_created,
+                      max__last_seen=date_created)
+        try:
+            return issues.modify(upsert=True, new=True, **update)
+        except mongo.NotUniqueError:
+            # Another worker has just inserted the same issue.
+            return issues.modify(new=True, **update)
 
     @classmethod
     def get_top_n_project_issues(cls, n, project_name):
         return cls.objects(product=project_name)[:n]
 
+    def get_last_seen_time(self):
+        last_seen = self.last_seen
+        if not last_seen:
+            # Not stored for issues of older versions until their stats
+            # are updated (see update-issue-stats)
+            minidump = self.get_minidumps().only('date_created').order_by(
+                '-date_created').first()
+            last_seen = minidump.date_created if minidump else None
+        return last_seen.strftime('%d-%m-%Y %H:%M') if last_seen else ''
+
     def __str__(self):
         return 'Issue: {} {} {} {} {} {} {}'.format(
             self.product, self.version, self.platform, self.reason,
-            self.location, self.total,
-            self.last_seen.strftime('%d-%m-%Y %H:%M'))
+            self.location, self.total, self.get_last_seen_time())
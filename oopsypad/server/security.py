@@ -4,7 +4,7 @@ from flask import current_app, redirect, request, session, jsonify
 from flask_login import utils as login_utils
 from flask_security import MongoEngineUserDatastore
 
-from oopsypad.server.models import db, User, Role
+from oopsypad.server.models import db, User, Role, user_cache
 
 user_datastore = MongoEngineUserDatastore(db, User, Role)
 
@@ -19,17 +19,23 @@ def load_security_extensions(app):
                     auth_token = request.headers.get(
                         'Authorization', '').replace('Basic ', '', 1)
                     auth_token = base64.b64decode(auth_token).decode()
-                except TypeError:
+                except (TypeError, ValueError):
                     return None
 
-                return User.objects(auth_token=auth_token).first()
+                return user_cache.get_or_load(
+                    ('token', auth_token),
+                    lambda: User.get_with_roles(auth_token=auth_token),
+                    current_app.config['USER_CACHE_TTL'])
             else:
                 user_id = session.get('user_id', '')
 
                 if not user_id:
                     return None
 
-                return User.objects(_id=user_id).first()
+                return user_cache.get_or_load(
+                    ('id', user_id),
+                    lambda: User.get_with_roles(_id=user_id),
+                    current_app.config['USER_CACHE_TTL'])
 
         @current_app.login_manager.unauthorized_handler
         def unauthorized_handler():
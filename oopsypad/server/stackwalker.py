@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import threading
+
+from oopsypad.server.config import Config
+
+
+def get_symbols_url_args(symbols_url):
+    """
+    Stackwalker arguments to download missing symfiles from `symbols_url`
+    (e.g. the /symbols endpoint of an OopsyPad server) to SYMFILES_DIR.
+    """
+    if not symbols_url:
+        return []
+    os.makedirs(Config.SYMFILES_DIR, exist_ok=True)
+    # Downloads are moved into the cache, so they are made on the same
+    # filesystem.
+    return ['--symbols-url', symbols_url,
+            '--symbols-cache', Config.SYMFILES_DIR,
+            '--symbols-tmp', Config.SYMFILES_DIR]
+
+
+class StackwalkerServer:
+    """
+    Client for a long-lived ``stackwalker --server`` process.
+
+    The process keeps parsed symbol files in memory between minidumps,
+    so it is started once per worker process and reused for every task.
+    """
+
+    def __init__(self, symbol_paths, cache_modules, cache_size,
+                 symbols_url=None):
+        self.args = ([Config.STACKWALKER, '--server',
+                      '--cache-modules', str(cache_modules),
+                      '--cache-size', str(cache_size)] +
+                     get_symbols_url_args(symbols_url) + symbol_paths)
+        self.process = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen(self.args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def walk(self, minidump_path):
+        with self.lock:
+            if not self.is_running():
+                self.start()
+            try:
+                self.process.stdin.write(minidump_path.encode() + b'\n')
+                self.process.stdin.flush()
+                output = self.process.stdout.readline()
+            except OSError:
+                output = None
+            if not output:
+                # The stackwalker died on this minidump, the next call
+                # starts a new one.
+                returncode = self.process.poll()
+                self.stop()
+                raise subprocess.CalledProcessError(returncode or -1,
+                                                    self.args)
+        return json.loads(output.decode())
+
+
+_server = None
+
+
+def walk_minidump(minidump_path, symbol_paths, cache_modules, cache_size,
+                  symbols_url=None):
+    global _server
+    # Celery forks its pool processes, so each of them gets its own server.
+    if _server is None or _server.pid != os.getpid():
+        _server = StackwalkerServer(symbol_paths, cache_modules, cache_size,
+                                    symbols_url)
+    return _server.walk(minidump_path)
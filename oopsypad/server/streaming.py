@@ -0,0 +1,84 @@
+import zlib
+
+from flask import Response, request
+
+
+def read_range(file, start, stop, chunk_size):
+    file.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = file.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def gzip_chunks(file, chunk_size):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_gzipped_gridfs_file(file, etag,
+                               mimetype='application/octet-stream'):
+    """
+    Stream a GridFS file compressing it on the fly.
+
+    The compressed length isn't known in advance, so range requests
+    aren't supported.
+    """
+    etag = '{}-gzip'.format(etag)
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    headers['Content-Encoding'] = 'gzip'
+    response = Response(gzip_chunks(file, file.chunk_size),
+                        mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    return response
+
+
+def stream_gridfs_file(file, etag, mimetype='application/octet-stream'):
+    """
+    Stream a GridFS file chunk by chunk instead of reading it into memory.
+
+    Conditional (If-None-Match) and single range (Range, If-Range)
+    requests are supported; multiple ranges are answered with the whole
+    file.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    length = file.length
+    start, stop = 0, length
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+
+    if_range = request.if_range
+    # There's no Last-Modified, so If-Range with a date never matches.
+    range_matches = (not (if_range.etag or if_range.date) or
+                     if_range.etag == etag)
+    if request.range and range_matches and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            headers['Content-Range'] = 'bytes */{}'.format(length)
+            return Response(status=416, headers=headers)
+        start, stop = byte_range
+        status = 206
+        headers['Content-Range'] = request.range.to_content_range_header(
+            length)
+
+    response = Response(read_range(file, start, stop, file.chunk_size),
+                        status=status, mimetype=mimetype, headers=headers)
+    response.content_length = stop - start
+    response.set_etag(etag)
+    return response
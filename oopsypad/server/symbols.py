@@ -0,0 +1,191 @@
+from collections import defaultdict
+import fcntl
+import os
+
+from oopsypad.server.config import Config
+from oopsypad.server.symindex import build_symindex, SymbolIndex
+
+SYMFILES_DIR = Config.SYMFILES_DIR
+UPLOAD_CHUNK_SIZE = Config.UPLOAD_CHUNK_SIZE
+SYMINDEX_EXTENSION = '.symindex'
+
+
+def get_missing_debug_ids(stacktrace_json):
+    return sorted({module['debug_id']
+                   for module in stacktrace_json.get('modules', [])
+                   if module.get('missing_symbols') and
+                   module.get('debug_id')})
+
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def touch_loaded_symfiles(stacktrace_json):
+    """
+    Mark symfiles used for a stacktrace as recently used, so the cache
+    trimming removes them last.
+    """
+    for module in stacktrace_json.get('modules', []):
+        if not module.get('loaded_symbols'):
+            continue
+        symfile_dir = os.path.join(SYMFILES_DIR, module.get('debug_file', ''),
+                                   module.get('debug_id', ''))
+        if os.path.isdir(symfile_dir):
+            for name in os.listdir(symfile_dir):
+                touch(os.path.join(symfile_dir, name))
+
+
+def get_local_symfile_path(symfile):
+    return os.path.join(symfile.get_symfile_path(), symfile.symfile_name)
+
+
+def get_local_symindex_path(symfile):
+    return get_local_symfile_path(symfile) + SYMINDEX_EXTENSION
+
+
+def fetch_symfile(symfile):
+    """
+    Make sure the symfile is present in the local symbols directory,
+    fetching it from GridFS if needed.  Returns True if it was fetched.
+    """
+    return fetch_gridfs_file(symfile.symfile, get_local_symfile_path(symfile))
+
+
+def fetch_symindex(symfile):
+    """
+    Return the local path of the symfile index, fetching it from GridFS if
+    needed, or None if the symfile has no index.
+    """
+    if not symfile.symindex:
+        return None
+    path = get_local_symindex_path(symfile)
+    fetch_gridfs_file(symfile.symindex, path)
+    return path if os.path.isfile(path) else None
+
+
+def fetch_gridfs_file(proxy, target_path):
+    """
+    Fetch a GridFS file to `target_path` unless it's already there.
+
+    Concurrent fetches of the same file (from other threads or worker
+    processes of the host) wait for the first one instead of downloading
+    it again.  Returns True if the file was fetched.
+    """
+    if os.path.isfile(target_path):
+        touch(target_path)
+        return False
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(get_lock_path(target_path), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(target_path):
+                return False
+            content = proxy.get()
+            if not content:
+                return False
+            tmp_path = '{}.{}.part'.format(target_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: content.read(UPLOAD_CHUNK_SIZE),
+                                  b''):
+                    f.write(chunk)
+            os.replace(tmp_path, target_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return True
+
+
+def create_symindex(symfile_path):
+    """
+    Build the index of a local symfile next to it and return its path.
+    """
+    index_path = symfile_path + SYMINDEX_EXTENSION
+    tmp_path = '{}.{}.part'.format(index_path, os.getpid())
+    with open(symfile_path, 'rb') as symfile, open(tmp_path, 'wb') as output:
+        build_symindex(symfile, output)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def get_unsymbolicated_frames(stacktrace_json):
+    """
+    Return frames without function names in modules the stackwalker had no
+    symbols for, by module debug ID.
+    """
+    debug_ids = {module.get('filename'): module['debug_id']
+                 for module in stacktrace_json.get('modules', [])
+                 if module.get('missing_symbols') and module.get('debug_id')}
+    threads = stacktrace_json.get('threads', []) + \
+        [stacktrace_json.get('crashing_thread') or {}]
+    frames = defaultdict(list)
+    for thread in threads:
+        for frame in thread.get('frames', []):
+            if not frame.get('function') and frame.get('module_offset') and \
+                    frame.get('module') in debug_ids:
+                frames[debug_ids[frame['module']]].append(frame)
+    return frames
+
+
+def symbolicate_frames(frames, index_path):
+    with SymbolIndex(index_path) as index:
+        for frame in frames:
+            symbol = index.lookup(int(frame['module_offset'], 16))
+            if symbol:
+                frame.update(symbol)
+
+
+def get_lock_path(path):
+    return '{}.lock'.format(path)
+
+
+def remove_cached_file(path):
+    """
+    Remove a fetched file along with its lock file.  Returns False if the
+    file could not be removed.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    try:
+        os.remove(get_lock_path(path))
+    except OSError:
+        pass
+    return True
+
+
+def trim_cache(max_size, get_fetchable_paths):
+    """
+    Remove the least recently used symfiles and indexes until the local
+    symbols take at most `max_size` bytes.  They are fetched again when
+    needed.
+
+    Only the paths returned by `get_fetchable_paths`, called with the
+    local paths, are removed: files put in the symbols directory by hand
+    can't be fetched again.
+    """
+    symfiles = []
+    for root, _, names in os.walk(SYMFILES_DIR):
+        for name in names:
+            if not name.endswith(('.sym', SYMINDEX_EXTENSION)):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            symfiles.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in symfiles)
+    if total <= max_size:
+        return
+    fetchable = get_fetchable_paths([path for _, _, path in symfiles])
+    for _, size, path in sorted(symfiles):
+        if total <= max_size:
+            break
+        if path in fetchable and remove_cached_file(path):
+            total -= size
@@ -0,0 +1,310 @@
+"""
+Compact binary index of Breakpad symbol files.
+
+Text symbol files have to be parsed entirely before any address can be
+looked up. The index keeps FUNC, line and PUBLIC records sorted by
+address, so a lookup binary searches a memory-mapped file and only
+touches the pages it needs.
+
+Line records, the bulk of symbol files, are delta-encoded as varints in
+blocks of LINES_PER_BLOCK records: a lookup binary searches the blocks by
+their first address and decodes a single block.
+
+Layout (little-endian):
+
+    header      magic, funcs, publics, files and line blocks counts,
+                line data size
+    funcs       address (Q), size (I), name offset (I)
+    publics     address (Q), name offset (I)
+    files       name offset (I)
+    line blocks first address (Q), line data offset (I)
+    line data   address delta, size, line delta (zigzag) and file number
+                varints of each record, the first address delta being
+                relative to the block first address
+    strings     NUL-terminated UTF-8 strings
+"""
+from array import array
+import bisect
+import mmap
+import struct
+
+MAGIC = b'OSYMIDX2'
+HEADER = struct.Struct('<8sIIIII')
+FUNC = struct.Struct('<QII')
+PUBLIC = struct.Struct('<QI')
+FILE = struct.Struct('<I')
+LINE_BLOCK = struct.Struct('<QI')
+LINES_PER_BLOCK = 64
+
+
+class InvalidSymbolIndex(Exception):
+    pass
+
+
+class StringTable:
+    def __init__(self):
+        self.offsets = {}
+        self.data = bytearray()
+
+    def add(self, string):
+        offset = self.offsets.get(string)
+        if offset is None:
+            offset = self.offsets[string] = len(self.data)
+            self.data += string.encode('utf8', 'replace') + b'\0'
+        return offset
+
+
+def write_varint(output, value):
+    while value > 0x7f:
+        output.append(value & 0x7f | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def read_varint(buffer, offset):
+    value = shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+
+def parse_symfile(lines):
+    """
+    Parse text symbol file lines (bytes) into address-sorted columns.
+    """
+    strings = StringTable()
+    files = {}
+    funcs = (array('Q'), array('I'), array('I'))
+    line_records = (array('Q'), array('I'), array('I'), array('I'))
+    publics = (array('Q'), array('I'))
+
+    for line in lines:
+        line = line.decode('utf8', 'replace').rstrip('\r\n')
+        if not line:
+            continue
+        if line.startswith('FILE '):
+            _, number, name = line.split(' ', 2)
+            files[int(number)] = name
+        elif line.startswith('FUNC '):
+            parts = line.split(' ', 5)
+            if parts[1] == 'm':
+                parts = parts[1:]
+            else:
+                parts = line.split(' ', 4)
+            address, size, _, name = parts[1:5]
+            funcs[0].append(int(address, 16))
+            funcs[1].append(int(size, 16))
+            funcs[2].append(strings.add(name))
+        elif line.startswith('PUBLIC '):
+            parts = line.split(' ', 4)
+            if parts[1] == 'm':
+                parts = parts[1:]
+            else:
+                parts = line.split(' ', 3)
+            address, _, name = parts[1:4]
+            publics[0].append(int(address, 16))
+            publics[1].append(strings.add(name))
+        elif line[0] in '0123456789abcdef':
+            address, size, line_number, file_number = line.split(' ', 3)
+            line_records[0].append(int(address, 16))
+            line_records[1].append(int(size, 16))
+            line_records[2].append(int(line_number))
+            # Resolved to a file table index once all FILE records are read
+            line_records[3].append(int(file_number))
+        # MODULE, INFO, STACK and other records aren't indexed.
+
+    # Files by index in the file table, unknown ones are left unnamed
+    file_numbers = {number: i for i, number in enumerate(sorted(files))}
+    file_names = [strings.add(files[number]) for number in sorted(files)]
+    unknown_file = len(file_names)
+    file_names.append(strings.add(''))
+    file_indexes = line_records[3]
+    for i, file_number in enumerate(file_indexes):
+        file_indexes[i] = file_numbers.get(file_number, unknown_file)
+    return strings, funcs, line_records, publics, file_names
+
+
+def sorted_records(columns):
+    order = sorted(range(len(columns[0])), key=columns[0].__getitem__)
+    return [tuple(column[i] for column in columns) for i in order]
+
+
+def encode_lines(records):
+    """
+    Delta-encode address-sorted line records into blocks.  Returns the
+    block index entries and the line data.
+    """
+    blocks = []
+    data = bytearray()
+    for i in range(0, len(records), LINES_PER_BLOCK):
+        previous_address = records[i][0]
+        previous_line = 0
+        blocks.append((previous_address, len(data)))
+        for address, size, line, file in records[i:i + LINES_PER_BLOCK]:
+            write_varint(data, address - previous_address)
+            write_varint(data, size)
+            write_varint(data, zigzag(line - previous_line))
+            write_varint(data, file)
+            previous_address, previous_line = address, line
+    return blocks, data
+
+
+def build_symindex(lines, output):
+    """
+    Write the index of text symbol file `lines` to the `output` stream.
+    """
+    strings, funcs, line_records, publics, files = parse_symfile(lines)
+    blocks, line_data = encode_lines(sorted_records(line_records))
+    output.write(HEADER.pack(MAGIC, len(funcs[0]), len(publics[0]),
+                             len(files), len(blocks), len(line_data)))
+    for record in sorted_records(funcs):
+        output.write(FUNC.pack(*record))
+    for record in sorted_records(publics):
+        output.write(PUBLIC.pack(*record))
+    for name in files:
+        output.write(FILE.pack(name))
+    for block in blocks:
+        output.write(LINE_BLOCK.pack(*block))
+    output.write(line_data)
+    output.write(strings.data)
+
+
+class Addresses:
+    """
+    Sequence of the addresses of a records table, for bisect.
+    """
+
+    def __init__(self, buffer, offset, record, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.record_size = record.size
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from(
+            '<Q', self.buffer, self.offset + index * self.record_size)[0]
+
+
+class SymbolIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, funcs, publics, files, blocks, line_data_size = \
+                HEADER.unpack_from(self.buffer)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            self.close()
+            raise InvalidSymbolIndex('{} is not a symbol index.'.format(path))
+
+        self.funcs_offset = HEADER.size
+        self.publics_offset = self.funcs_offset + funcs * FUNC.size
+        self.files_offset = self.publics_offset + publics * PUBLIC.size
+        self.blocks_offset = self.files_offset + files * FILE.size
+        self.line_data_offset = self.blocks_offset + blocks * LINE_BLOCK.size
+        self.strings_offset = self.line_data_offset + line_data_size
+        self.funcs = Addresses(self.buffer, self.funcs_offset, FUNC, funcs)
+        self.publics = Addresses(self.buffer, self.publics_offset, PUBLIC,
+                                 publics)
+        self.blocks = Addresses(self.buffer, self.blocks_offset, LINE_BLOCK,
+                                blocks)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_string(self, offset):
+        start = self.strings_offset + offset
+        end = self.buffer.find(b'\0', start)
+        return self.buffer[start:end].decode('utf8')
+
+    def get_file(self, index):
+        return self.get_string(FILE.unpack_from(
+            self.buffer, self.files_offset + index * FILE.size)[0])
+
+    @staticmethod
+    def find(addresses, address):
+        index = bisect.bisect_right(addresses, address) - 1
+        return index if index >= 0 else None
+
+    def find_line(self, address):
+        """
+        Return the last line record (address, size, line, file index)
+        starting at or before `address`, or None.
+        """
+        index = self.find(self.blocks, address)
+        if index is None:
+            return None
+        line_address, start = LINE_BLOCK.unpack_from(
+            self.buffer, self.blocks_offset + index * LINE_BLOCK.size)
+        if index + 1 < len(self.blocks):
+            _, end = LINE_BLOCK.unpack_from(
+                self.buffer, self.blocks_offset +
+                (index + 1) * LINE_BLOCK.size)
+        else:
+            end = self.strings_offset - self.line_data_offset
+        offset = self.line_data_offset + start
+        end += self.line_data_offset
+
+        record = None
+        line = 0
+        while offset < end:
+            delta, offset = read_varint(self.buffer, offset)
+            line_address += delta
+            if line_address > address:
+                break
+            size, offset = read_varint(self.buffer, offset)
+            line_delta, offset = read_varint(self.buffer, offset)
+            file, offset = read_varint(self.buffer, offset)
+            line += unzigzag(line_delta)
+            record = (line_address, size, line, file)
+        return record
+
+    def lookup(self, address):
+        """
+        Return frame fields (function, function_offset, file, line) for a
+        module offset, in the stackwalker JSON format, or None.
+        """
+        index = self.find(self.funcs, address)
+        if index is not None:
+            start, size, name = FUNC.unpack_from(
+                self.buffer, self.funcs_offset + index * FUNC.size)
+            if address < start + size:
+                frame = {'function': self.get_string(name),
+                         'function_offset': hex(address - start)}
+                record = self.find_line(address)
+                if record:
+                    line_start, line_size, line, file = record
+                    if address < line_start + line_size:
+                        frame['file'] = self.get_file(file)
+                        frame['line'] = line
+                return frame
+
+        index = self.find(self.publics, address)
+        if index is not None:
+            start, name = PUBLIC.unpack_from(
+                self.buffer, self.publics_offset + index * PUBLIC.size)
+            return {'function': self.get_string(name),
+                    'function_offset': hex(address - start)}
+        return None
@@ -4,6 +4,7 @@ import signal
 import subprocess
 from time import sleep
 
+from bson import ObjectId
 from celery import Celery
 import click
 import raven
@@ -14,6 +15,11 @@ from oopsypad.server.run import app
 
 CELERY_LOG = os.path.join(app.config['ROOT_DIR'], 'celery.log')
 CELERYD_PID = os.path.join(app.config['ROOT_DIR'], 'celeryd.pid')
+CELERYBEAT_SCHEDULE_FILE = os.path.join(app.config['ROOT_DIR'],
+                                        'celerybeat-schedule')
+# Tasks sent without a queue which go to the reprocessing one
+BACKGROUND_TASKS = ('reprocess_missing_symbols', 'resolve_issues',
+                    'apply_retention_policies')
 
 
 def make_celery(app):
@@ -21,6 +27,13 @@ def make_celery(app):
                     backend=app.config['CELERY_RESULT_BACKEND'],
                     broker=app.config['CELERY_BROKER_URL'])
     celery.conf.update(app.config)
+    # Only the queues consumed by workers by default (see run --queues)
+    celery.conf.update(
+        CELERY_DEFAULT_QUEUE=app.config['CRASH_REPORT_QUEUE'],
+        CELERY_ROUTES={
+            '{}.{}'.format(__name__, task): {
+                'queue': app.config['REPROCESS_QUEUE']}
+            for task in BACKGROUND_TASKS})
     TaskBase = celery.Task
 
     class ContextTask(TaskBase):
@@ -57,34 +70,133 @@ def process_minidump(minidump_id):
     if not minidump:
         logger.error('Minidump {} was not found.'.format(minidump_id))
         return
-    minidump.get_stacktrace()
-    minidump.parse_stacktrace()
+    minidump.process()
     logger.info('Minidump {} was processed.'.format(minidump_id))
 
 
+@celery.task
+def process_minidumps(minidump_ids):
+    for minidump in models.Minidump.objects(id__in=minidump_ids):
+        # One broken minidump shouldn't stop the rest of the batch.
+        try:
+            minidump.process_stacktrace()
+        except Exception as e:
+            logger.exception('Cannot process minidump {}: {}'.format(
+                minidump.id, e))
+    logger.info('{} minidumps were processed.'.format(len(minidump_ids)))
+
+
+def reprocess_minidumps(minidump_ids):
+    # Reprocessing has its own queue, so it never delays new crash reports.
+    return process_minidumps.apply_async(
+        args=[minidump_ids], queue=app.config['REPROCESS_QUEUE'])
+
+
+@celery.task
+def reprocess_missing_symbols(symfile_id):
+    minidump_ids = [str(minidump_id) for minidump_id in
+                    models.Minidump.objects(missing_symbols=symfile_id)
+                    .scalar('id')]
+    batch_size = app.config['REPROCESS_BATCH_SIZE']
+    for i in range(0, len(minidump_ids), batch_size):
+        reprocess_minidumps(minidump_ids[i:i + batch_size])
+    logger.info('{} minidumps missing symbols {} were queued.'.format(
+        len(minidump_ids), symfile_id))
+
+
+@celery.task
+def build_symindex(symfile_id):
+    symfile = models.Symfile.objects(id=symfile_id).first()
+    if not symfile:
+        logger.error('Symfile {} was not found.'.format(symfile_id))
+        return
+    symfile.build_symindex()
+    logger.info('Symfile {} was indexed.'.format(symfile.symfile_id))
+
+
+@celery.task(bind=True)
+def resolve_issues(self, issue_ids):
+    issues = models.Issue.objects(id__in=issue_ids)
+    for i, issue in enumerate(issues):
+        logger.info('Resolving issue {}...'.format(issue.id))
+
+        def report_progress(removed, total):
+            self.update_state(state='PROGRESS',
+                              meta={'issue': i + 1,
+                                    'issues': len(issue_ids),
+                                    'removed': removed,
+                                    'total': total})
+
+        issue.resolve_issue(progress=report_progress)
+        logger.info('Issue {} was resolved.'.format(issue.id))
+
+
+@celery.task
+def apply_retention_policies():
+    for project in models.Project.objects():
+        removed = project.apply_retention_policy()
+        if removed:
+            logger.info('{} old minidumps of {} were removed.'.format(
+                removed, project.name))
+
+
+def get_worker_file(path, name):
+    # Each named worker gets its own pid, log and beat schedule files.
+    if name:
+        root, ext = os.path.splitext(path)
+        path = '{}-{}{}'.format(root, name, ext)
+    return path
+
+
+name_option = click.option('--name',
+                           help='Worker name, to run several workers on '
+                                'the same host.')
+
+
 @click.group('oopsy_celery_worker')
 def oopsy_celery_worker():
     pass
 
 
 @oopsy_celery_worker.command('run')
-def oopsy_celery_worker_run():
-    if os.path.isfile(CELERYD_PID):
+@click.option('--beat/--no-beat', default=True,
+              help='Run periodic tasks (e.g. retention policies) in this '
+                   'worker (default is on).')
+@click.option('--queues', '-Q',
+              default=lambda: '{},{}'.format(app.config['CRASH_REPORT_QUEUE'],
+                                             app.config['REPROCESS_QUEUE']),
+              help='Comma separated queues to consume (default are crash '
+                   'report and reprocessing queues).')
+@name_option
+def oopsy_celery_worker_run(beat, queues, name):
+    pidfile = get_worker_file(CELERYD_PID, name)
+    if os.path.isfile(pidfile):
         if click.confirm('Celery worker is already running. Restart?',
                          default=True):
-            terminate_celery_worker()
+            terminate_celery_worker(name)
             click.echo('Restarting...')
-    while os.path.isfile(CELERYD_PID):
+    while os.path.isfile(pidfile):
         sleep(.25)
-    subprocess.run(['celery', 'worker', '-A', 'oopsypad.server.worker.celery',
-                    '--detach', '--loglevel', 'info', '--logfile', CELERY_LOG,
-                    '--pidfile', CELERYD_PID])
+    args = ['celery', 'worker', '-A', 'oopsypad.server.worker.celery',
+            '--detach', '--loglevel', 'info',
+            '--logfile', get_worker_file(CELERY_LOG, name),
+            '--pidfile', pidfile,
+            '--queues', queues,
+            # Don't hold tasks for busy pool processes, so that queues are
+            # consumed in turn.
+            '-O', 'fair']
+    if name:
+        args += ['--hostname', '{}@%h'.format(name)]
+    if beat:
+        args += ['--beat', '--schedule',
+                 get_worker_file(CELERYBEAT_SCHEDULE_FILE, name)]
+    subprocess.run(args)
     click.echo('Celery worker is running.')
 
 
-def terminate_celery_worker():
+def terminate_celery_worker(name=None):
     try:
-        with open(CELERYD_PID) as pid:
+        with open(get_worker_file(CELERYD_PID, name)) as pid:
             os.kill(int(pid.read()), signal.SIGTERM)
             click.echo('Celery worker process was terminated.')
     except OSError:
@@ -92,16 +204,135 @@ def terminate_celery_worker():
 
 
 @oopsy_celery_worker.command('stop')
-def oopsy_celery_worker_stop():
-    terminate_celery_worker()
+@name_option
+def oopsy_celery_worker_stop(name):
+    terminate_celery_worker(name)
 
 
 @oopsy_celery_worker.command('logs')
 @click.option('--number', '-n', default=0, type=int, help='Show last n entries.')
-def oopsy_celery_worker_logs(number):
+@name_option
+def oopsy_celery_worker_logs(number, name):
     try:
-        with open(CELERY_LOG) as logs:
+        with open(get_worker_file(CELERY_LOG, name)) as logs:
             for line in logs.readlines()[-number:]:
                 click.echo(line)
     except OSError:
         click.echo('No logfile found.')
+
+
+@oopsy_celery_worker.command('update-issue-stats')
+def oopsy_celery_worker_update_issue_stats():
+    """Recalculate first/last seen dates and uptime of all issues."""
+    with app.app_context():
+        issues = models.Issue.objects()
+        with click.progressbar(issues, length=issues.count(),
+                               label='Updating issues') as bar:
+            for issue in bar:
+                issue.update_stats()
+
+
+@oopsy_celery_worker.command('rebuild-crash-counters')
+def oopsy_celery_worker_rebuild_crash_counters():
+    """Rebuild daily crash counters from the stored minidumps."""
+    with app.app_context():
+        count = models.CrashCounter.rebuild()
+    click.echo('{} crash counters were rebuilt.'.format(count))
+
+
+def validate_object_id(ctx, param, value):
+    if value is not None and not ObjectId.is_valid(value):
+        raise click.BadParameter('{} is not a valid id.'.format(value))
+    return value
+
+
+@oopsy_celery_worker.command('reprocess')
+@click.option('--product', help='Product name.')
+@click.option('--version', help='Product version.')
+@click.option('--platform', help='Platform name.')
+@click.option('--since', type=click.DateTime(),
+              help='Reprocess crash reports received since this date.')
+@click.option('--until', type=click.DateTime(),
+              help='Reprocess crash reports received before this date.')
+@click.option('--issue', callback=validate_object_id,
+              help='Reprocess crash reports of this issue.')
+@click.option('--after', callback=validate_object_id,
+              help='Resume after this crash report id.')
+@click.option('--batch-size', default=100, type=int,
+              help='Crash reports per task (default is 100).')
+@click.option('--pause', default=1.0, type=float,
+              help='Seconds to wait between batches (default is 1).')
+@click.option('--dry-run', is_flag=True,
+              help='Only count the crash reports to reprocess.')
+def oopsy_celery_worker_reprocess(product, version, platform, since, until,
+                                  issue, after, batch_size, pause, dry_run):
+    """Walk stored crash reports again, e.g. after a stackwalker upgrade."""
+    with app.app_context():
+        if issue:
+            issue = models.Issue.objects(id=issue).first()
+            if not issue:
+                raise click.BadParameter('Issue not found.',
+                                         param_hint='--issue')
+            minidumps = issue.get_minidumps()
+        else:
+            minidumps = models.Minidump.objects()
+        filters = dict(product=product, version=version, platform=platform,
+                       date_created__gte=since, date_created__lt=until)
+        minidumps = minidumps.filter(
+            **{k: v for k, v in filters.items() if v is not None})
+
+        def get_batch(cursor):
+            batch = minidumps.filter(id__gt=cursor) if cursor else minidumps
+            return [str(minidump_id) for minidump_id in
+                    batch.order_by('id').limit(batch_size).scalar('id')]
+
+        total = (minidumps.filter(id__gt=after) if after else
+                 minidumps).count()
+        if dry_run:
+            click.echo('{} crash reports would be reprocessed.'.format(total))
+            return
+
+        cursor = after
+        try:
+            with click.progressbar(length=total,
+                                   label='Queueing crash reports') as bar:
+                while True:
+                    minidump_ids = get_batch(cursor)
+                    if not minidump_ids:
+                        break
+                    reprocess_minidumps(minidump_ids)
+                    cursor = minidump_ids[-1]
+                    bar.update(len(minidump_ids))
+                    sleep(pause)
+        except KeyboardInterrupt:
+            if cursor:
+                click.echo('Interrupted, use --after {} to resume.'.format(
+                    cursor))
+            raise click.Abort()
+        click.echo('{} crash reports were queued.'.format(total))
+
+
+@oopsy_celery_worker.command('migrate-stacktraces')
+def oopsy_celery_worker_migrate_stacktraces():
+    """Move stacktraces out of crash report documents into their store."""
+    with app.app_context():
+        total = models.Minidump.get_legacy_stacktrace_minidumps().count()
+        with click.progressbar(length=total,
+                               label='Migrating stacktraces') as bar:
+            models.Minidump.migrate_stacktraces(progress=bar.update)
+    click.echo('{} stacktraces were migrated.'.format(total))
+
+
+@oopsy_celery_worker.command('build-symbol-indexes')
+@click.option('--all', 'rebuild', is_flag=True,
+              help='Also rebuild existing indexes, e.g. of an older format.')
+def oopsy_celery_worker_build_symbol_indexes(rebuild):
+    """Build indexes of symbol files uploaded before they were introduced."""
+    with app.app_context():
+        symfiles = models.Symfile.objects()
+        if not rebuild:
+            symfiles = symfiles.filter(symindex__exists=False)
+        with click.progressbar(symfiles, length=symfiles.count(),
+                               label='Indexing symbol files') as bar:
+            for symfile in bar:
+                symfile.build_symindex()
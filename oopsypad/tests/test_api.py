@@ -1,22 +1,38 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import fcntl
+import hashlib
+import io
 import json
 import os
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
 
+from bson import ObjectId
+from click.testing import CliRunner
 from ddt import ddt, data, unpack
+from flask import url_for
 from flask_testing import TestCase
+from mongoengine import GridFSProxy
 import pymongo
+from werkzeug.datastructures import FileStorage
 
 from oopsypad.client.symfile import create_symfile
-from oopsypad.server import config, demo, models
+from oopsypad.server import config, demo, models, symbols
 from oopsypad.server.app import create_app
-from oopsypad.tests.utils import fake_create_stacktrace_worker
+from oopsypad.tests.utils import (fake_create_stacktrace_worker,
+                                  fake_create_stacktraces_worker,
+                                  fake_create_symindex_worker,
+                                  fake_reprocess_minidumps_worker)
 
 TEST_APP = 'test_app'
 MIN_VERSION = '0.8'
 LINUX = 'Linux'
 ALLOWED_PLATFORMS = [LINUX, 'MacOS', 'Windows']
+TEST_APP_DEBUG_ID = 'FFD6D2F408BA1933C5D159EF5CACD9A40'  # Minidump fixture
 
 
 class TestBase(TestCase):
@@ -24,6 +40,12 @@ class TestBase(TestCase):
     def create_app(self):
         patch.object(models.Minidump, 'create_stacktrace',
                      new=fake_create_stacktrace_worker).start()
+        patch.object(models.Minidump, 'create_stacktraces',
+                     new=fake_create_stacktraces_worker).start()
+        patch.object(models.Symfile, 'reprocess_minidumps',
+                     new=fake_reprocess_minidumps_worker).start()
+        patch.object(models.Symfile, 'create_symindex',
+                     new=fake_create_symindex_worker).start()
         app = create_app(config_name=config.TEST)
         return app
 
@@ -33,12 +55,32 @@ class TestBase(TestCase):
     def tearDown(self):
         patch.stopall()
         self.drop_db()
+        models.project_policies.clear()
+        models.user_cache.clear()
 
     @staticmethod
     def drop_db():
         pymongo.MongoClient('mongodb://localhost:27017/').drop_database(
             config.TestConfig.MONGODB_SETTINGS.get('DB'))
 
+    def login(self, email=demo.DEV_EMAIL):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.client.post('/login', data={'email': email,
+                                         'password': demo.PSW})
+
+    def send_crash_report_response(self, product, version, platform):
+
+        minidump_path = os.path.join('oopsypad', 'tests', 'fixtures',
+                                     'minidump.dmp')
+        with open(minidump_path, 'rb') as f:
+            data = {'product': product,
+                    'version': version,
+                    'platform': platform,
+                    'upload_file_minidump': f}
+            response = self.client.post('/crash-report', data=data,
+                                        content_type='multipart/form-data')
+        return response
+
     @staticmethod
     def create_test_data():
         for platform in ALLOWED_PLATFORMS:
@@ -79,24 +121,39 @@ class SymfileTest(TestBase):
             print(response.json)
             self.assertEqual(response.json, {'ok': 'Symbol file was saved.'})
 
+    def test_get_symfile(self):
+        symfile_id = '0123456789ABCDEF0123456789ABCDEF0'
+        content = 'MODULE Linux x86_64 {} {}\n'.format(
+            symfile_id, TEST_APP).encode()
+        models.Symfile.create_symfile(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            symfile_id=symfile_id,
+            file=FileStorage(io.BytesIO(content),
+                             filename='{}.sym'.format(TEST_APP)))
+        url = '/symbols/{0}/{1}/{0}.sym'.format(TEST_APP, symfile_id)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404,
+                         'Symbol server is enabled by default.')
+
+        self.app.config['SYMBOL_SERVER'] = True
+        response = self.client.get(
+            '/symbols/{0}/{1}/other.sym'.format(TEST_APP, symfile_id))
+        self.assertEqual(response.status_code, 404, 'Wrong symfile served.')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content, 'Wrong symfile content.')
+
+        response = self.client.get(
+            url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
 
 @ddt
 class CrashReportTest(TestBase):
     url = '/crash-report'
 
-    def send_crash_report_response(self, product, version, platform):
-
-        minidump_path = os.path.join('oopsypad', 'tests', 'fixtures',
-                                     'minidump.dmp')
-        with open(minidump_path, 'rb') as f:
-            data = {'product': product,
-                    'version': version,
-                    'platform': platform,
-                    'upload_file_minidump': f}
-            response = self.client.post(self.url, data=data,
-                                        content_type='multipart/form-data')
-        return response
-
     @data(
         (TEST_APP, '0.7', LINUX, 'bad version',
          {'error': 'You use an old version. Please download at least {} '
@@ -117,6 +174,19 @@ class CrashReportTest(TestBase):
                              fail_reason, response.json))
         self.assertEqual(response.json, error, 'Wrong error.')
 
+    def test_send_corrupt_crash_report(self):
+        data = {'product': TEST_APP,
+                'version': '0.9',
+                'platform': LINUX,
+                'upload_file_minidump': (io.BytesIO(b'MDMP' + b'\0' * 10),
+                                         'minidump.dmp')}
+        response = self.client.post(self.url, data=data,
+                                    content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(models.Minidump.objects.count(), 0,
+                         'Corrupt minidump was stored.')
+
     def test_send_crash_report(self):
         product, version, platform = TEST_APP, '0.9', LINUX
         response = self.send_crash_report_response(product, version, platform)
@@ -143,6 +213,138 @@ class CrashReportTest(TestBase):
                          'Wrong crash address.')
         self.assertEqual(minidump.crash_reason, 'SIGSEGV',
                          'Wrong crash reason.')
+        self.assertEqual(minidump.crash_module,
+                         'EBFEE3FBB7FB8EF19EAC1C8A6F2D46000',
+                         'Wrong crash module.')
+        self.assertEqual(minidump.crash_module_offset, '0x19cb20',
+                         'Wrong crash module offset.')
+
+    def test_local_minidump_removed(self):
+        with tempfile.TemporaryDirectory() as dumps_dir, \
+                patch.object(models, 'DUMPS_DIR', dumps_dir):
+            self.send_crash_report_response(TEST_APP, '0.9', LINUX)
+            self.assertEqual(os.listdir(dumps_dir), [],
+                             'Local minidump copy was kept.')
+
+        minidump = models.Minidump.objects(product=TEST_APP).first()
+        self.assertTrue(minidump.signature, 'Minidump was not processed.')
+        self.assertIsNone(minidump.file_path, 'Local path was stored.')
+
+    def test_send_crash_report_batch(self):
+        minidump_path = os.path.join('oopsypad', 'tests', 'fixtures',
+                                     'minidump.dmp')
+        with open(minidump_path, 'rb') as f:
+            content = f.read()
+        data = {'product': TEST_APP,
+                'version': '0.9',
+                'platform': LINUX,
+                'metadata': json.dumps([{}, {'platform': 'What?'}, {},
+                                        {'version': 1.0}]),
+                'upload_file_minidump': [
+                    (io.BytesIO(content), 'first.dmp'),
+                    (io.BytesIO(content), 'second.dmp'),
+                    (io.BytesIO(b'MDMP'), 'third.dmp'),
+                    (io.BytesIO(content), 'fourth.dmp')]}
+        response = self.client.post(self.url + '/batch', data=data,
+                                    content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.json['results']],
+                         [201, 400, 400, 400], 'Wrong statuses.')
+        self.assertEqual(models.Minidump.objects.count(), 1,
+                         'Wrong number of stored minidumps.')
+
+    def test_reprocess_missing_symbols(self):
+        # Walk with the fixture symbols missing, without cached ones.
+        self.app.config['STACKWALKER_SERVER'] = False
+        with tempfile.TemporaryDirectory() as symfiles_dir, \
+                patch.object(models, 'SYMFILES_DIR', symfiles_dir), \
+                patch.object(symbols, 'SYMFILES_DIR', symfiles_dir):
+            self.send_crash_report_response(TEST_APP, '0.9', LINUX)
+            minidump = models.Minidump.objects(product=TEST_APP).first()
+            self.assertIn(TEST_APP_DEBUG_ID, minidump.missing_symbols,
+                          'Missing symbols were not recorded.')
+
+            content = 'MODULE Linux x86_64 {} {}\n'.format(
+                TEST_APP_DEBUG_ID, TEST_APP).encode()
+            with patch.object(models.Minidump, 'process_stacktrace',
+                              autospec=True) as process_stacktrace:
+                models.Symfile.create_symfile(
+                    product=TEST_APP, version='0.9', platform=LINUX,
+                    symfile_id=TEST_APP_DEBUG_ID,
+                    file=FileStorage(io.BytesIO(content),
+                                     filename='{}.sym'.format(TEST_APP)))
+
+        self.assertEqual(process_stacktrace.call_count, 1,
+                         'Minidump was not reprocessed.')
+        self.assertEqual(process_stacktrace.call_args[0][0].id, minidump.id,
+                         'Wrong minidump reprocessed.')
+
+    def test_duplicate_crash_report(self):
+        product, version, platform = TEST_APP, '0.9', LINUX
+        for _ in range(2):
+            response = self.send_crash_report_response(product, version,
+                                                       platform)
+            self.assertEqual(response.status_code, 201)
+
+        minidumps = models.Minidump.objects(product=product)
+        self.assertEqual(minidumps.count(), 1, 'Duplicate was stored.')
+        self.assertEqual(minidumps.first().duplicates, 1,
+                         'Wrong duplicates count.')
+
+    def test_concurrent_duplicate_crash_report(self):
+        # Indexes are gone with the database dropped after previous tests.
+        models.Minidump.ensure_indexes()
+        product, version, platform = TEST_APP, '0.9', LINUX
+        self.send_crash_report_response(product, version, platform)
+
+        get_duplicate = models.Minidump.get_duplicate
+        calls = []
+
+        def miss_first_lookup(product, checksum):
+            # As if the other request stored it after this lookup
+            calls.append(checksum)
+            return get_duplicate(product, checksum) if len(calls) > 1 \
+                else None
+
+        with patch.object(models.Minidump, 'get_duplicate',
+                          side_effect=miss_first_lookup):
+            response = self.send_crash_report_response(product, version,
+                                                       platform)
+        self.assertEqual(response.status_code, 201)
+
+        minidumps = models.Minidump.objects(product=product)
+        self.assertEqual(minidumps.count(), 1, 'Duplicate was stored.')
+        self.assertEqual(minidumps.first().duplicates, 1,
+                         'Wrong duplicates count.')
+        self.assertEqual(
+            models.Minidump._get_db()['fs.files'].count_documents({}), 1,
+            'Duplicate minidump file was kept.')
+
+    def test_crash_counter(self):
+        product, version, platform = TEST_APP, '0.9', LINUX
+        self.send_crash_report_response(product, version, platform)
+
+        counter = models.CrashCounter.objects(product=product,
+                                              version=version,
+                                              platform=platform).first()
+        self.assertIsNotNone(counter, 'Crash counter was not created.')
+        self.assertEqual(counter.count, 1, 'Wrong crash count.')
+
+    def test_issue_signature(self):
+        product, version, platform = TEST_APP, '0.9', LINUX
+        self.send_crash_report_response(product, version, platform)
+
+        minidump = models.Minidump.objects(product=product).first()
+        self.assertTrue(minidump.signature, 'Signature was not computed.')
+
+        issue = models.Issue.objects(
+            signature_hash=minidump.signature_hash).first()
+        self.assertIsNotNone(issue, 'Issue was not created.')
+        self.assertEqual(issue.signature, minidump.signature,
+                         'Wrong issue signature.')
+        self.assertEqual(issue.get_minidumps().count(), 1,
+                         'Wrong issue minidumps.')
 
 
 @ddt
@@ -161,6 +363,49 @@ class TokenTest(TestBase):
         self.assertEqual(response.json.get('token'), token)
 
 
+class UserCacheTest(TestBase):
+    headers = {'Authorization': base64.b64encode(demo.ADMIN_TOKEN.encode())}
+
+    @staticmethod
+    def update_admin(**fields):
+        admin = models.User.objects(email=demo.ADMIN_EMAIL).first()
+        for name, value in fields.items():
+            setattr(admin, name, value)
+        admin.save()
+
+    def test_token_roles(self):
+        response = self.client.get('/api/projects', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        self.update_admin(roles=[models.Role.objects(name='developer')
+                                 .first()])
+        response = self.client.get('/api/projects', headers=self.headers)
+        self.assertEqual(response.status_code, 403, 'Cached user was used.')
+
+    def test_session_roles(self):
+        with self.app.test_request_context():
+            url = url_for('project.index_view')
+        self.login(demo.ADMIN_EMAIL)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        self.update_admin(roles=[models.Role.objects(name='developer')
+                                 .first()])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302, 'Cached user was used.')
+
+    def test_token_active(self):
+        self.client.get('/api/projects', headers=self.headers)
+        key = ('token', demo.ADMIN_TOKEN)
+        cached = models.user_cache.get_or_load(key, lambda: None, 60)
+        self.assertTrue(cached and cached.active, 'User was not cached.')
+
+        self.update_admin(active=False)
+        self.assertEqual(
+            models.user_cache.get_or_load(key, lambda: 'reloaded', 60),
+            'reloaded', 'Cached user was kept.')
+
+
 @ddt
 class ProjectsTest(TestBase):
 
@@ -194,6 +439,50 @@ class ProjectsTest(TestBase):
         if token == demo.ADMIN_TOKEN:
             self.assertIsNotNone(response.json.get('ok'))
 
+    def test_project_add_clears_policy(self):
+        response = self.send_crash_report_response('other_app', '0.9', LINUX)
+        self.assertEqual(response.json,
+                         {'error': 'other_app project not found.'})
+
+        url = '/api/projects/other_app'
+        headers = {'content-type': 'application/json',
+                   'Authorization': base64.b64encode(
+                       demo.ADMIN_TOKEN.encode())}
+        self.client.post(url, headers=headers,
+                         data=json.dumps({'allowed_platforms': [LINUX]}))
+
+        response = self.send_crash_report_response('other_app', '0.9', LINUX)
+        self.assertEqual(response.status_code, 201,
+                         'Cached policy was used: {}'.format(response.json))
+
+    def test_project_delete_clears_policy(self):
+        response = self.send_crash_report_response(TEST_APP, '0.9', LINUX)
+        self.assertEqual(response.status_code, 201)
+
+        url = '/api/projects/{name}/delete'.format(name=TEST_APP)
+        headers = {'Authorization': base64.b64encode(
+            demo.ADMIN_TOKEN.encode())}
+        self.client.delete(url, headers=headers)
+
+        response = self.send_crash_report_response(TEST_APP, '0.9', LINUX)
+        self.assertEqual(response.json,
+                         {'error': '{} project not found.'.format(TEST_APP)},
+                         'Cached policy was used.')
+
+    def test_platform_save_clears_policy(self):
+        response = self.send_crash_report_response(TEST_APP, '0.9', LINUX)
+        self.assertEqual(response.status_code, 201)
+
+        platform = models.Platform.objects(name=LINUX).first()
+        platform.name = 'GNU/Linux'
+        platform.save()
+
+        response = self.send_crash_report_response(TEST_APP, '0.9', LINUX)
+        self.assertEqual(response.json,
+                         {'error': '{} platform is not allowed for {}.'.format(
+                             LINUX, TEST_APP)},
+                         'Cached policy was used.')
+
     @data((demo.ADMIN_TOKEN, 200),
           (demo.DEV_TOKEN, 403),
           (demo.SYM_TOKEN, 403))
@@ -208,5 +497,538 @@ class ProjectsTest(TestBase):
             self.assertIsNotNone(response.json.get('projects'))
 
 
+class IssueTest(TestBase):
+
+    def create_minidump(self, signature='foo', date_created=None,
+                        process_uptime=10):
+        """
+        Store a processed minidump and return its issue.
+        """
+        minidump = models.Minidump(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            crash_reason='SIGSEGV', crash_location='test_app + 0x10',
+            signature=signature,
+            signature_hash=hashlib.sha1(signature.encode()).hexdigest(),
+            date_created=date_created or datetime.now(),
+            process_uptime=process_uptime)
+        minidump.save()
+        if process_uptime is None:
+            minidump.update(unset__process_uptime=True)
+        return models.Issue.create_or_update_issue(
+            product=minidump.product, version=minidump.version,
+            platform=minidump.platform, reason=minidump.crash_reason,
+            location=minidump.crash_location, signature=minidump.signature,
+            signature_hash=minidump.signature_hash,
+            date_created=minidump.date_created,
+            process_uptime=process_uptime)
+
+    def test_drop_legacy_indexes(self):
+        collection = models.Issue._get_db()[
+            models.Issue._get_collection_name()]
+        keys = [('product', 1), ('version', 1), ('platform', 1),
+                ('reason', 1), ('location', 1)]
+
+        # Index of databases created before signatures
+        collection.create_index(keys)
+        models.Issue.drop_legacy_indexes()
+        self.assertIn(models.ISSUE_LOCATION_INDEX,
+                      collection.index_information(),
+                      'Non-unique index was dropped.')
+        models.Issue.ensure_indexes()
+
+        collection.drop_index(models.ISSUE_LOCATION_INDEX)
+        collection.create_index(keys, unique=True)
+        models.Issue.drop_legacy_indexes()
+        self.assertNotIn(models.ISSUE_LOCATION_INDEX,
+                         collection.index_information(),
+                         'Unique index was not dropped.')
+        models.Issue.ensure_indexes()
+
+        self.create_minidump('foo')
+        self.create_minidump('bar')
+        self.assertEqual(models.Issue.objects.count(), 2,
+                         'Signatures at the same location were merged.')
+
+    def test_legacy_issue_minidumps(self):
+        # Issue and minidump of a crash processed before signatures
+        legacy_minidump = models.Minidump(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            crash_reason='SIGSEGV', crash_location='test_app + 0x10',
+            date_created=datetime.now())
+        legacy_minidump.save()
+        legacy_issue = models.Issue(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            reason='SIGSEGV', location='test_app + 0x10', total=1)
+        legacy_issue.save()
+        issue = self.create_minidump()
+
+        self.assertEqual(list(legacy_issue.get_minidumps()),
+                         [legacy_minidump], 'Wrong legacy issue minidumps.')
+        legacy_issue.update_stats()
+        self.assertEqual(legacy_issue.total, 1, 'Wrong legacy issue total.')
+
+        legacy_issue.resolve_issue()
+        self.assertEqual(list(models.Issue.objects), [issue],
+                         'Wrong issues resolved.')
+        self.assertEqual(issue.get_minidumps().count(), 1,
+                         'Minidumps of the signature issue were removed.')
+
+    def test_issue_without_stats(self):
+        # Issue of a version without denormalized stats
+        date_created = datetime(2018, 1, 2, 3, 4)
+        minidump = models.Minidump(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            crash_reason='SIGSEGV', crash_location='test_app + 0x10',
+            date_created=date_created)
+        minidump.save()
+        issue = models.Issue(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            reason='SIGSEGV', location='test_app + 0x10', total=1)
+        issue.save()
+        self.assertEqual(issue.get_last_seen_time(), '02-01-2018 03:04',
+                         'Wrong last seen date.')
+        self.assertIn('02-01-2018 03:04', str(issue))
+
+        project = models.Project.objects(name=TEST_APP).first()
+        with self.app.test_request_context():
+            urls = [url_for('issue.details_view', id=issue.id),
+                    url_for('project.details_view', id=project.id)]
+        self.login(demo.ADMIN_EMAIL)
+        for url in urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200,
+                             'Cannot show {}'.format(url))
+
+    def test_copy_known_crash(self):
+        crash = dict(product=TEST_APP, version='0.9', platform=LINUX,
+                     crash_module=TEST_APP_DEBUG_ID,
+                     crash_module_offset='0x10')
+        minidump = models.Minidump(date_created=datetime.now(), **crash)
+        minidump.save()
+
+        def create_known_minidump(function):
+            signature = '{} | main'.format(function)
+            known = models.Minidump(
+                crash_reason='SIGSEGV', crash_location='test_app + 0x10',
+                signature=signature,
+                signature_hash=hashlib.sha1(signature.encode()).hexdigest(),
+                date_created=datetime.now(), **crash)
+            known.save()
+            models.MinidumpStacktrace.store(known.id, 'stacktrace', {
+                'crashing_thread': {'frames': [{'function': function,
+                                                'module': TEST_APP}]}})
+            return known
+
+        known = create_known_minidump('malloc')
+        self.assertFalse(minidump.copy_known_crash(),
+                         'Crash in a prefix frame was copied.')
+
+        known.delete()
+        known = create_known_minidump('foo')
+        self.assertTrue(minidump.copy_known_crash(), 'Crash was not copied.')
+        minidump.reload()
+        self.assertEqual(minidump.signature_hash, known.signature_hash,
+                         'Wrong signature.')
+        self.assertEqual(models.Issue.objects(
+            signature_hash=known.signature_hash).count(), 1,
+            'Issue was not created.')
+
+    def test_update_stats(self):
+        self.create_minidump(process_uptime=10)
+        self.create_minidump(process_uptime=20)
+        issue = self.create_minidump(process_uptime=None)
+        self.assertEqual(issue.avg_uptime, 15, 'Wrong average uptime.')
+
+        issue.update_stats()
+        self.assertEqual(issue.total, 3, 'Wrong total.')
+        self.assertEqual(issue.uptime_count, 2, 'Wrong uptime count.')
+        self.assertEqual(issue.avg_uptime, 15, 'Wrong average uptime.')
+
+    def create_minidumps(self, *days_ago):
+        now = datetime.now()
+        for days in days_ago:
+            self.create_minidump(date_created=now - timedelta(days=days),
+                                 process_uptime=days)
+        return models.Issue.objects.first()
+
+    def apply_retention_policy(self, **policy):
+        project = models.Project.objects(name=TEST_APP).first()
+        project.update(**policy)
+        project.reload()
+        return project.apply_retention_policy()
+
+    def test_retention_max_count(self):
+        issue = self.create_minidumps(1, 2, 3, 4)
+
+        removed = self.apply_retention_policy(retention_max_per_issue=2)
+        self.assertEqual(removed, 2, 'Wrong number of removed minidumps.')
+
+        issue.reload()
+        self.assertEqual(issue.total, 2, 'Wrong total.')
+        self.assertEqual(issue.get_minidumps().count(), 2,
+                         'Wrong issue minidumps.')
+        self.assertEqual(issue.avg_uptime, 1, 'Wrong average uptime.')
+        self.assertEqual(issue.first_seen, min(
+            m.date_created for m in issue.get_minidumps()),
+            'Wrong first seen date.')
+
+    def test_retention_older_than(self):
+        issue = self.create_minidumps(1, 15, 20)
+        unprocessed = models.Minidump(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            date_created=datetime.now() - timedelta(days=20))
+        unprocessed.save()
+
+        removed = self.apply_retention_policy(retention_days=10)
+        self.assertEqual(removed, 3, 'Wrong number of removed minidumps.')
+        self.assertIsNone(models.Minidump.get_by_id(unprocessed.id),
+                          'Unprocessed minidump was kept.')
+
+        issue.reload()
+        self.assertEqual(issue.total, 1, 'Wrong total.')
+        self.assertEqual(issue.first_seen, issue.last_seen,
+                         'Wrong first seen date.')
+        self.assertEqual(issue.uptime_sum, 1, 'Wrong uptime.')
+
+    def test_retention_keep(self):
+        issue = self.create_minidumps(15, 20, 30)
+
+        removed = self.apply_retention_policy(retention_days=10,
+                                              retention_keep_samples=2)
+        self.assertEqual(removed, 1, 'Wrong number of removed minidumps.')
+
+        issue.reload()
+        self.assertEqual(issue.total, 2, 'Wrong total.')
+        self.assertEqual(issue.avg_uptime, 17, 'Wrong average uptime.')
+
+        removed = self.apply_retention_policy(retention_max_per_issue=1)
+        self.assertEqual(removed, 0, 'Kept minidumps were removed.')
+
+    def test_resolve_issues_task(self):
+        with patch.dict(os.environ, {'OOPSY_ENV': config.TEST}):
+            from oopsypad.server import worker
+        issue = self.create_minidumps(1, 2)
+        other_issue = self.create_minidump('bar')
+
+        with patch.object(worker.resolve_issues,
+                          'update_state') as update_state:
+            worker.resolve_issues([str(issue.id)])
+
+        self.assertEqual(list(models.Issue.objects), [other_issue],
+                         'Wrong issues resolved.')
+        self.assertEqual(models.Minidump.objects.count(), 1,
+                         'Issue minidumps were not removed.')
+        update_state.assert_called_with(
+            state='PROGRESS',
+            meta={'issue': 1, 'issues': 1, 'removed': 2, 'total': 2})
+
+    def test_background_task_queues(self):
+        with patch.dict(os.environ, {'OOPSY_ENV': config.TEST}):
+            from oopsypad.server import worker
+        conf = worker.celery.conf
+        self.assertEqual(conf['CELERY_DEFAULT_QUEUE'],
+                         self.app.config['CRASH_REPORT_QUEUE'])
+        for task in (worker.reprocess_missing_symbols, worker.resolve_issues,
+                     worker.apply_retention_policies):
+            self.assertEqual(conf['CELERY_ROUTES'][task.name],
+                             {'queue': self.app.config['REPROCESS_QUEUE']},
+                             'Wrong {} queue.'.format(task.name))
+
+    def test_remove_minidumps(self):
+        minidump = models.Minidump(product=TEST_APP,
+                                   date_created=datetime.now())
+        minidump.minidump.put(b'MDMP', filename='minidump.dmp')
+        minidump.save()
+        models.MinidumpStacktrace.store(minidump.id, 'stacktrace', {})
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            file_path = f.name
+        grid_id = minidump.minidump.grid_id
+
+        models.Minidump.remove_minidumps([
+            {'_id': minidump.id, 'minidump': grid_id,
+             'file_path': file_path},
+            # Files of minidumps may be missing.
+            {'_id': ObjectId(), 'file_path': file_path + '.missing'}])
+
+        self.assertIsNone(models.Minidump.get_by_id(minidump.id),
+                          'Minidump was not removed.')
+        self.assertIsNone(GridFSProxy(grid_id).get(),
+                          'Minidump file was not removed.')
+        self.assertFalse(os.path.exists(file_path),
+                         'Local minidump file was not removed.')
+        self.assertEqual(models.MinidumpStacktrace.objects.count(), 0,
+                         'Stacktrace was not removed.')
+
+    def test_retention_removes_empty_issue(self):
+        self.create_minidumps(15, 20)
+
+        removed = self.apply_retention_policy(retention_days=10)
+        self.assertEqual(removed, 2, 'Wrong number of removed minidumps.')
+        self.assertEqual(models.Issue.objects.count(), 0,
+                         'Empty issue was kept.')
+
+
+class StacktraceTest(TestBase):
+    stacktrace_json = {'crash_info': {'type': 'SIGSEGV'}}
+
+    def create_legacy_minidump(self, **stacktrace):
+        """
+        Insert a minidump document of a version which kept stacktraces in
+        it.
+        """
+        collection = models.Minidump._get_collection()
+        return collection.insert_one(dict(
+            product=TEST_APP, date_created=datetime.now(),
+            **stacktrace)).inserted_id
+
+    def test_stored_stacktrace(self):
+        minidump = models.Minidump(product=TEST_APP,
+                                   date_created=datetime.now())
+        minidump.save()
+        minidump.set_stacktrace('stacktrace', self.stacktrace_json)
+        minidump.save_processing_results()
+
+        minidump = models.Minidump.get_by_id(minidump.id)
+        self.assertEqual(minidump.stacktrace, 'stacktrace')
+        self.assertEqual(minidump.stacktrace_json, self.stacktrace_json)
+        self.assertNotIn('stacktrace', minidump.to_mongo(),
+                         'Stacktrace was stored in the minidump.')
+
+        minidumps = list(models.Minidump.objects)
+        models.Minidump.prefetch_stacktraces(minidumps)
+        with patch.object(models.MinidumpStacktrace, 'objects') as objects:
+            self.assertEqual(minidumps[0].stacktrace, 'stacktrace')
+        objects.assert_not_called()
+
+    def test_legacy_stacktrace(self):
+        minidump_id = self.create_legacy_minidump(
+            stacktrace='stacktrace', stacktrace_json=self.stacktrace_json)
+
+        minidump = models.Minidump.get_by_id(minidump_id)
+        self.assertEqual(minidump.stacktrace, 'stacktrace')
+        self.assertEqual(minidump.stacktrace_json, self.stacktrace_json)
+
+    def test_migrate_stacktraces(self):
+        with patch.dict(os.environ, {'OOPSY_ENV': config.TEST}):
+            from oopsypad.server import worker
+        minidump_id = self.create_legacy_minidump(
+            stacktrace='stacktrace', stacktrace_json=self.stacktrace_json)
+        json_only_id = self.create_legacy_minidump(
+            stacktrace_json=self.stacktrace_json)
+
+        result = CliRunner().invoke(worker.oopsy_celery_worker,
+                                    ['migrate-stacktraces'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('2 stacktraces were migrated.', result.output)
+
+        collection = models.Minidump._get_collection()
+        for document in collection.find():
+            self.assertNotIn('stacktrace', document,
+                             'Legacy stacktrace was kept.')
+            self.assertNotIn('stacktrace_json', document,
+                             'Legacy stacktrace JSON was kept.')
+        minidump = models.Minidump.get_by_id(minidump_id)
+        self.assertEqual(minidump.stacktrace, 'stacktrace')
+        self.assertEqual(minidump.stacktrace_json, self.stacktrace_json)
+        minidump = models.Minidump.get_by_id(json_only_id)
+        self.assertIsNone(minidump.stacktrace)
+        self.assertEqual(minidump.stacktrace_json, self.stacktrace_json)
+
+
+class ReprocessTest(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        with patch.dict(os.environ, {'OOPSY_ENV': config.TEST}):
+            from oopsypad.server import worker
+        self.worker = worker
+        self.minidump_ids = []
+        for _ in range(5):
+            minidump = models.Minidump(product=TEST_APP,
+                                       date_created=datetime.now())
+            minidump.save()
+            self.minidump_ids.append(str(minidump.id))
+        models.Minidump(product='other', date_created=datetime.now()).save()
+
+    def reprocess(self, *args):
+        with patch.object(self.worker, 'reprocess_minidumps') as reprocess:
+            result = CliRunner().invoke(
+                self.worker.oopsy_celery_worker,
+                ['reprocess', '--product', TEST_APP, '--pause', '0'] +
+                list(args))
+        self.assertEqual(result.exit_code, 0, result.output)
+        batches = [call[0][0] for call in reprocess.call_args_list]
+        return result.output, batches
+
+    def test_batches(self):
+        output, batches = self.reprocess('--batch-size', '2')
+        self.assertEqual(batches, [self.minidump_ids[:2],
+                                   self.minidump_ids[2:4],
+                                   self.minidump_ids[4:]])
+        self.assertIn('5 crash reports were queued.', output)
+
+    def test_after(self):
+        output, batches = self.reprocess('--batch-size', '2',
+                                         '--after', self.minidump_ids[1])
+        self.assertEqual(batches, [self.minidump_ids[2:4],
+                                   self.minidump_ids[4:]])
+        self.assertIn('3 crash reports were queued.', output)
+
+    def test_dry_run(self):
+        output, batches = self.reprocess('--dry-run')
+        self.assertEqual(batches, [])
+        self.assertIn('5 crash reports would be reprocessed.', output)
+
+        output, batches = self.reprocess('--dry-run',
+                                         '--after', self.minidump_ids[3])
+        self.assertEqual(batches, [])
+        self.assertIn('1 crash reports would be reprocessed.', output)
+
+
+class DownloadTest(TestBase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        minidump = models.Minidump(product=TEST_APP,
+                                   date_created=datetime.now())
+        minidump.minidump.put(self.content,
+                              content_type='application/octet-stream',
+                              filename='minidump.dmp')
+        minidump.save()
+        with self.app.test_request_context():
+            self.url = minidump.download_link
+        self.etag = str(minidump.minidump.grid_id)
+        self.login()
+
+    def test_download_minidump(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.content, 'Wrong content.')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+
+    def test_download_range(self):
+        response = self.client.get(self.url,
+                                   headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.content[10:20],
+                         'Wrong range content.')
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 10-19/{}'.format(len(self.content)))
+
+    def test_download_range_if_range(self):
+        response = self.client.get(self.url,
+                                   headers={'Range': 'bytes=10-19',
+                                            'If-Range': '"{}"'.format(
+                                                self.etag)})
+        self.assertEqual(response.status_code, 206)
+
+        response = self.client.get(self.url,
+                                   headers={'Range': 'bytes=10-19',
+                                            'If-Range': '"other"'})
+        self.assertEqual(response.status_code, 200,
+                         'Range of a changed file was sent.')
+        self.assertEqual(response.data, self.content, 'Wrong content.')
+
+    def test_download_unsatisfiable_range(self):
+        response = self.client.get(self.url, headers={
+            'Range': 'bytes={}-'.format(len(self.content))})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes */{}'.format(len(self.content)))
+
+    def test_download_not_modified(self):
+        response = self.client.get(self.url, headers={
+            'If-None-Match': '"{}"'.format(self.etag)})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'', 'Content of 304 was sent.')
+
+
+class SymbolsCacheTest(TestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.symfiles_dir = tempfile.TemporaryDirectory()
+        patch.object(models, 'SYMFILES_DIR', self.symfiles_dir.name).start()
+        patch.object(symbols, 'SYMFILES_DIR', self.symfiles_dir.name).start()
+
+    def tearDown(self):
+        super().tearDown()
+        self.symfiles_dir.cleanup()
+
+    @staticmethod
+    def create_symfile(symfile_id, size=100):
+        content = 'MODULE Linux x86_64 {} {}\n'.format(symfile_id, TEST_APP)
+        content += 'PUBLIC 1000 0 {}\n'.format('f' * size)
+        return models.Symfile.create_symfile(
+            product=TEST_APP, version='0.9', platform=LINUX,
+            symfile_id=symfile_id,
+            file=FileStorage(io.BytesIO(content.encode()),
+                             filename='{}.sym'.format(TEST_APP)))
+
+    def test_fetch_symfile(self):
+        symfile = self.create_symfile(TEST_APP_DEBUG_ID)
+        path = symbols.get_local_symfile_path(symfile)
+        with open(path, 'rb') as f:
+            content = f.read()
+        os.remove(path)
+
+        self.assertTrue(symbols.fetch_symfile(symfile), 'Not fetched.')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content, 'Wrong symfile content.')
+        self.assertFalse(symbols.fetch_symfile(symfile),
+                         'Local symfile was fetched again.')
+
+    def test_fetch_symfile_locked(self):
+        symfile = self.create_symfile(TEST_APP_DEBUG_ID)
+        path = symbols.get_local_symfile_path(symfile)
+        os.remove(path)
+
+        with open(symbols.get_lock_path(path), 'w') as lock, \
+                ThreadPoolExecutor(max_workers=1) as executor:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fetched = executor.submit(symbols.fetch_symfile, symfile)
+            time.sleep(0.2)
+            self.assertFalse(fetched.done(), 'Lock was not waited for.')
+            # As if fetched by the lock holder
+            with open(path, 'wb') as f:
+                f.write(b'fetched')
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            self.assertFalse(fetched.result(timeout=5),
+                             'Symfile was fetched twice.')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'fetched', 'Symfile was replaced.')
+
+    def test_trim_cache(self):
+        old = self.create_symfile('0' * 33)
+        new = self.create_symfile('1' * 33)
+        old_path = symbols.get_local_symfile_path(old)
+        new_path = symbols.get_local_symfile_path(new)
+        for path in (old_path, new_path):
+            os.remove(path)
+            os.remove(path + symbols.SYMINDEX_EXTENSION)
+        symbols.fetch_symfile(old)
+        symbols.fetch_symfile(new)
+        manual_path = os.path.join(self.symfiles_dir.name, 'manual',
+                                   '2' * 33, 'manual.sym')
+        os.makedirs(os.path.dirname(manual_path))
+        with open(manual_path, 'wb') as f:
+            f.write(b'MODULE Linux x86_64 manual')
+        now = time.time()
+        os.utime(manual_path, (now - 30, now - 30))
+        os.utime(old_path, (now - 20, now - 20))
+
+        symbols.trim_cache(
+            os.path.getsize(new_path) + os.path.getsize(manual_path),
+            models.Symfile.get_fetchable_paths)
+
+        self.assertFalse(os.path.exists(old_path), 'Old symfile was kept.')
+        self.assertFalse(os.path.exists(symbols.get_lock_path(old_path)),
+                         'Lock file was kept.')
+        self.assertTrue(os.path.exists(manual_path),
+                        'Symfile not in the database was removed.')
+        self.assertTrue(os.path.exists(new_path), 'New symfile was removed.')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,67 @@
+import io
+import os
+import unittest
+
+from oopsypad.server import minidump
+
+TEST_APP = 'test_app'
+TEST_APP_DEBUG_ID = 'FFD6D2F408BA1933C5D159EF5CACD9A40'  # Minidump fixture
+
+
+class MinidumpReaderTest(unittest.TestCase):
+
+    def test_read_minidump_info(self):
+        minidump_path = os.path.join('oopsypad', 'tests', 'fixtures',
+                                     'minidump.dmp')
+        with open(minidump_path, 'rb') as f:
+            info = minidump.read_minidump_info(f)
+            self.assertEqual(f.tell(), 0, 'File position was changed.')
+
+        self.assertTrue(info.os.startswith('Linux'), 'Wrong OS.')
+        self.assertEqual(info.cpu_arch, 'amd64', 'Wrong CPU.')
+        self.assertEqual(info.crash_address, 0xfee1dead,
+                         'Wrong crash address.')
+        # The crash address is the faulting one, the instruction pointer
+        # is in QDir destructor.
+        self.assertEqual(info.crash_module.filename, 'libQt5Core.so.5.9.1',
+                         'Wrong crash module.')
+        self.assertEqual(
+            info.instruction_pointer - info.crash_module.base_addr,
+            0x19cb20, 'Wrong crash module offset.')
+        self.assertEqual(info.modules[0].filename, TEST_APP,
+                         'Wrong main module.')
+        self.assertEqual(info.modules[0].debug_id, TEST_APP_DEBUG_ID,
+                         'Wrong debug ID.')
+
+    def test_truncated_unread_stream(self):
+        minidump_path = os.path.join('oopsypad', 'tests', 'fixtures',
+                                     'minidump.dmp')
+        with open(minidump_path, 'rb') as f:
+            data = bytearray(f.read())
+        # Make a stream which isn't read (e.g. memory) overrun the file.
+        _, _, streams, directory_rva, _, _, _ = \
+            minidump.HEADER.unpack_from(data)
+        for i in range(streams):
+            offset = directory_rva + i * minidump.DIRECTORY_ENTRY.size
+            stream_type, size, rva = \
+                minidump.DIRECTORY_ENTRY.unpack_from(data, offset)
+            if stream_type not in minidump.READ_STREAMS:
+                minidump.DIRECTORY_ENTRY.pack_into(data, offset, stream_type,
+                                                   len(data), rva)
+                break
+
+        info = minidump.read_minidump_info(io.BytesIO(bytes(data)))
+        self.assertEqual(info.modules[0].debug_id, TEST_APP_DEBUG_ID,
+                         'Wrong debug ID.')
+
+    def test_truncated_minidump(self):
+        minidump_path = os.path.join('oopsypad', 'tests', 'fixtures',
+                                     'minidump.dmp')
+        with open(minidump_path, 'rb') as f:
+            data = f.read(1024)
+        with self.assertRaises(minidump.MinidumpError):
+            minidump.read_minidump_info(io.BytesIO(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
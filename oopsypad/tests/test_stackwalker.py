@@ -0,0 +1,58 @@
+import subprocess
+import sys
+import unittest
+
+from oopsypad.server import stackwalker
+
+# Answers every minidump path with its JSON line, dies on "crash" ones.
+FAKE_STACKWALKER = """
+import json
+import sys
+
+for line in sys.stdin:
+    if 'crash' in line:
+        sys.exit(1)
+    print(json.dumps({'minidump': line.strip()}), flush=True)
+"""
+
+
+class StackwalkerServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = stackwalker.StackwalkerServer([], 64, 0)
+        self.server.args = [sys.executable, '-c', FAKE_STACKWALKER]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_walk(self):
+        self.assertEqual(self.server.walk('first.dmp'),
+                         {'minidump': 'first.dmp'})
+        process = self.server.process
+        self.assertEqual(self.server.walk('second.dmp'),
+                         {'minidump': 'second.dmp'})
+        self.assertIs(self.server.process, process,
+                      'Stackwalker was restarted.')
+
+    def test_restart_after_crash(self):
+        self.server.walk('first.dmp')
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.server.walk('crash.dmp')
+        self.assertIsNone(self.server.process,
+                          'Dead stackwalker was kept.')
+
+        self.assertEqual(self.server.walk('second.dmp'),
+                         {'minidump': 'second.dmp'},
+                         'Stackwalker was not restarted.')
+        self.assertTrue(self.server.is_running())
+
+    def test_args(self):
+        server = stackwalker.StackwalkerServer(['/symbols'], 8, 1024)
+        self.assertEqual(server.args[1:], ['--server',
+                                           '--cache-modules', '8',
+                                           '--cache-size', '1024',
+                                           '/symbols'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import io
+import tempfile
+import unittest
+
+from oopsypad.server import symindex
+
+
+class SymbolIndexTest(unittest.TestCase):
+    symfile = b"""MODULE Linux x86_64 0123456789ABCDEF0 test_app
+FILE 0 main.cc
+FUNC m 1000 30 0 main
+1000 10 10 0
+1010 20 12 0
+PUBLIC 3000 0 _start
+"""
+
+    def lookup(self, symfile, addresses):
+        output = io.BytesIO()
+        symindex.build_symindex(io.BytesIO(symfile), output)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(output.getvalue())
+            f.flush()
+            with symindex.SymbolIndex(f.name) as index:
+                return [index.lookup(address) for address in addresses]
+
+    def test_lookup(self):
+        main, start, unknown = self.lookup(self.symfile,
+                                           [0x1015, 0x3008, 0x500])
+        self.assertEqual(main, {'function': 'main',
+                                'function_offset': '0x15',
+                                'file': 'main.cc',
+                                'line': 12})
+        self.assertEqual(start, {'function': '_start',
+                                 'function_offset': '0x8'})
+        self.assertIsNone(unknown)
+
+    def test_lookup_line_blocks(self):
+        # Line records span several delta-encoded blocks, lines go back
+        # and forth and one refers to an undeclared file.
+        count = symindex.LINES_PER_BLOCK * 3 + 5
+        lines = [b'FILE 0 a.cc', b'FILE 7 b.cc',
+                 b'FUNC 1000 %x 0 f' % (count * 4)]
+        for i in range(count):
+            lines.append(b'%x 2 %d %d' % (0x1000 + i * 4, 1000 - i * 7 % 500,
+                                          (0, 7, 3)[i % 3]))
+        frames = self.lookup(b'\n'.join(lines),
+                             [0x1000 + i * 4 + i % 4 for i in range(count)])
+        for i, frame in enumerate(frames):
+            expected = {'function': 'f',
+                        'function_offset': hex(i * 4 + i % 4)}
+            if i % 4 < 2:
+                expected['file'] = ('a.cc', 'b.cc', '')[i % 3]
+                expected['line'] = 1000 - i * 7 % 500
+            self.assertEqual(frame, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
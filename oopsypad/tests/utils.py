@@ -3,5 +3,19 @@ from oopsypad.server import models
 
 def fake_create_stacktrace_worker(minidump):
     minidump = models.Minidump.get_by_id(minidump.id)
-    minidump.get_stacktrace()
-    minidump.parse_stacktrace()
+    minidump.process()
+
+
+def fake_create_stacktraces_worker(minidumps):
+    for minidump in minidumps:
+        fake_create_stacktrace_worker(minidump)
+
+
+def fake_reprocess_minidumps_worker(symfile):
+    for minidump in models.Minidump.objects(
+            missing_symbols=symfile.symfile_id):
+        minidump.process_stacktrace()
+
+
+def fake_create_symindex_worker(symfile):
+    symfile.build_symindex()